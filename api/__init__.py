@@ -2,4 +2,5 @@ from .server import ApiServer
 from .utils import ApiError, api_success
 from . import oauth
 from .router import ApiRoute
+from .push import PushHub
 from . import routes
@@ -0,0 +1,115 @@
+import time
+import asyncio
+import hashlib
+from aiohttp.web import Response
+
+from core import cfg, dc
+from core.utils import TTLCache
+from core.cfg_factory import CfgFactory
+from .ipc import Ipc
+
+
+class ResponseCache:
+    """
+    Server side cache of the read-only api routes responses.
+    Responses are stored per user {user_id: {(path, query): (expires_at, etag, body)}}, so evicting or
+    invalidating a user drops all the user responses at once.
+    Entries are invalidated per user on oauth refresh or guild list changes,
+    and for all dashboard users of a guild on the guild config updates and guild events.
+    """
+
+    MAX_PER_USER = 64  # Oldest responses of a user are dropped above this size
+    TTL = getattr(cfg, 'API_RESPONSE_CACHE_TTL', 60)
+
+    # {user_id: {(path, query): (expires_at, etag, body)}}, user_id is None for the routes without auth
+    cache = TTLCache(max_size=getattr(cfg, 'API_RESPONSE_CACHE_SIZE', 4096), ttl=TTL)
+
+    @staticmethod
+    def make_etag(body: bytes) -> str:
+        return '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+
+    @staticmethod
+    def etag_matches(if_none_match: str | None, etag: str) -> str | None:
+        """
+        Check If-None-Match header against the etag, ignoring content-coding suffix added by the compression.
+        Returns the matching tag as sent by the client, it must be sent back with the 304 response.
+        """
+
+        if not if_none_match:
+            return None
+        for tag in if_none_match.split(','):
+            if (
+                (stripped := (tag := tag.strip()).removeprefix('W/')) == '*' or
+                stripped == etag or stripped.rsplit('-', 1)[0] + '"' == etag
+            ):
+                return etag if stripped == '*' else tag
+        return None
+
+    @classmethod
+    def get(cls, user_id: int | None, key: tuple) -> tuple[str, bytes] | None:
+        if (
+            (responses := cls.cache.get(user_id)) is not None and
+            (item := responses.get(key)) is not None and
+            item[0] > time.monotonic()
+        ):
+            return item[1], item[2]
+        return None
+
+    @classmethod
+    def set(cls, user_id: int | None, key: tuple, body: bytes) -> str:
+        etag = cls.make_etag(body)
+        if (responses := cls.cache.get(user_id)) is None:
+            responses = dict()
+        responses.pop(key, None)
+        while len(responses) >= cls.MAX_PER_USER:
+            del responses[next(iter(responses))]
+        responses[key] = (time.monotonic() + cls.TTL, etag, body)
+        cls.cache.set(user_id, responses)  # Prolongs the user ttl, every response keeps its own expiry time
+        return etag
+
+    @staticmethod
+    def response(etag: str, body: bytes | None = None) -> Response:
+        """ 200 response with the cached body or 304 response if body is None """
+        if body is None:
+            return Response(status=304, headers={'ETag': etag})
+        return Response(status=200, content_type='application/json', body=body, headers={'ETag': etag})
+
+    @classmethod
+    def invalidate_user(cls, user_id: int):
+        cls.cache.pop(user_id)
+
+    @classmethod
+    async def invalidate_guild(cls, guild_id: int):
+        from .oauth import get_guild_users
+
+        if len(user_ids := await get_guild_users(guild_id)):
+            Ipc.publish('responses_changed', user_ids=user_ids)
+
+
+@Ipc.listener('responses_changed')
+def invalidate_users(user_ids: list[int]):
+    for user_id in user_ids:
+        ResponseCache.invalidate_user(user_id)
+
+
+def on_config_change(factory, config, guild):
+    if guild is not None:
+        asyncio.create_task(ResponseCache.invalidate_guild(guild.id))
+
+
+CfgFactory.listeners.append(on_config_change)
+
+
+@dc.event
+async def on_guild_join(guild):
+    await ResponseCache.invalidate_guild(guild.id)
+
+
+@dc.event
+async def on_guild_remove(guild):
+    await ResponseCache.invalidate_guild(guild.id)
+
+
+@dc.event
+async def on_guild_update(before, after):
+    await ResponseCache.invalidate_guild(after.id)
@@ -0,0 +1,116 @@
+import time
+import asyncio
+import hashlib
+from collections import OrderedDict
+from typing import Any
+from aiohttp import ClientSession, TCPConnector
+
+from core import Log
+
+
+class Bucket:
+    """
+    Rate limit state of a single discord rate limit bucket.
+    Requests run concurrently while the bucket has remaining requests, the lock is only held
+    to take a request from the bucket, so waiters are queued only when the bucket is exhausted.
+    """
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.limit = None  # Unknown until the first response
+        self.remaining = None
+        self.reset_at = 0  # time.monotonic() timestamp
+
+    async def acquire(self):
+        async with self.lock:
+            if self.remaining is not None and self.remaining <= 0:
+                if (delay := self.reset_at - time.monotonic()) > 0:
+                    await asyncio.sleep(delay)
+                self.remaining = self.limit
+            if self.remaining is not None:
+                self.remaining -= 1
+
+    def update(self, headers):
+        if (limit := headers.get('X-RateLimit-Limit')) is not None:
+            self.limit = int(limit)
+        if (remaining := headers.get('X-RateLimit-Remaining')) is None:
+            return
+        now = time.monotonic()
+        reset_at = now + float(headers.get('X-RateLimit-Reset-After', 0))
+        if self.remaining is None or self.reset_at <= now:  # New rate limit window
+            self.remaining = int(remaining)
+        else:  # Responses of the concurrent requests may arrive out of order
+            self.remaining = min(self.remaining, int(remaining))
+        self.reset_at = max(self.reset_at, reset_at)
+
+
+class DiscordApi:
+    """
+    Shared keep-alive aiohttp session for the discord api calls.
+    Requests are limited per rate limit bucket, a bucket is (X-RateLimit-Bucket, hash of the Authorization header)
+    as the oauth2 routes are limited per access token. Routes are mapped to the bucket hashes from the
+    response headers, until then the (method, url) is used as the bucket. 429 responses are retried
+    after the retry_after delay.
+    """
+
+    MAX_RETRIES = 3
+    MAX_BUCKETS = 10000  # Least recently used buckets are dropped above this size
+
+    session = None
+    routes = dict()  # {(method, url): X-RateLimit-Bucket}
+    buckets = OrderedDict()  # {(bucket hash or (method, url), authorization hash): Bucket}, least recently used first
+    global_reset_at = 0  # time.monotonic() timestamp, set on global rate limit
+
+    @classmethod
+    async def start(cls):
+        cls.session = ClientSession(connector=TCPConnector(limit=100, ttl_dns_cache=300, keepalive_timeout=60))
+
+    @classmethod
+    async def close(cls):
+        if cls.session is not None:
+            await cls.session.close()
+            cls.session = None
+
+    @classmethod
+    def get_bucket(cls, method: str, url: str, authorization: str | None) -> Bucket:
+        key = (cls.routes.get((method, url), (method, url)), authorization)
+        if (bucket := cls.buckets.get(key)) is None:
+            if len(cls.buckets) >= cls.MAX_BUCKETS:
+                cls.buckets.popitem(last=False)
+            bucket = cls.buckets[key] = Bucket()
+        else:
+            cls.buckets.move_to_end(key)
+        return bucket
+
+    @classmethod
+    async def request(cls, method: str, url: str, **kwargs) -> tuple[int, Any]:
+        """ Make a request to the discord api, returns (response status, response json or None) """
+
+        if (authorization := kwargs.get('headers', {}).get('Authorization')) is not None:
+            authorization = hashlib.sha256(authorization.encode()).hexdigest()  # Don't keep the access tokens
+        for attempt in range(cls.MAX_RETRIES + 1):
+            bucket = cls.get_bucket(method, url, authorization)
+            await bucket.acquire()
+            if (delay := cls.global_reset_at - time.monotonic()) > 0:
+                await asyncio.sleep(delay)
+
+            async with cls.session.request(method, url, **kwargs) as resp:
+                if (bucket_hash := resp.headers.get('X-RateLimit-Bucket')) is not None:
+                    if cls.routes.get((method, url)) != bucket_hash:
+                        cls.routes[(method, url)] = bucket_hash
+                        bucket = cls.get_bucket(method, url, authorization)
+                bucket.update(resp.headers)
+                data = await resp.json() if resp.content_type == 'application/json' else None
+
+                if resp.status != 429:
+                    return resp.status, data
+
+                retry_after = float((data or {}).get('retry_after', resp.headers.get('Retry-After', 1)))
+                Log.info(f"API| Rate limited by discord on {method} {url}, retrying after {retry_after}s.")
+                if resp.headers.get('X-RateLimit-Global'):
+                    cls.global_reset_at = time.monotonic() + retry_after
+                else:
+                    bucket.remaining = 0
+                    bucket.reset_at = time.monotonic() + retry_after
+
+        return 429, None
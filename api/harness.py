@@ -0,0 +1,78 @@
+"""
+Runs the api with worker processes and the Ipc server on this machine without connecting to discord,
+then measures /api/test throughput and requests distribution between the workers.
+Usage: python -m api.harness [workers] [requests] [concurrency]
+"""
+
+import sys
+import time
+import asyncio
+from collections import Counter
+from aiohttp import ClientSession, ClientError, TCPConnector
+
+from core import cfg, Db, Log
+from modules.bot import Bot
+from .server import ApiServer
+
+
+async def wait_ready(session: ClientSession, url: str, workers: int, timeout: float = 30):
+    """ Wait until all workers answer """
+
+    seen = set()
+    deadline = time.monotonic() + timeout
+    while len(seen) < workers and time.monotonic() < deadline:
+        try:
+            async with session.get(url) as resp:
+                if resp.status == 200:
+                    seen.add(resp.headers.get('X-Api-Worker'))
+        except ClientError:
+            await asyncio.sleep(0.2)
+    return len(seen)
+
+
+async def main(workers: int, requests: int, concurrency: int):
+    Bot.bot_ready = True  # There is no discord connection, let the api serve requests
+    await Db.init()
+    await ApiServer.start(workers=workers)
+
+    host = '127.0.0.1' if cfg.API_HOST in ('0.0.0.0', '') else cfg.API_HOST
+    url = f"https://{host}:{cfg.API_PORT}/api/test"
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    served_by = Counter()
+    statuses = Counter()
+
+    async def request(session: ClientSession):
+        async with semaphore:
+            start = time.perf_counter()
+            async with session.get(url) as resp:
+                await resp.read()
+                statuses[resp.status] += 1
+                served_by[resp.headers.get('X-Api-Worker')] += 1
+            latencies.append(time.perf_counter() - start)
+
+    try:
+        # Certificate is not verified, self-signed ones are fine here
+        async with ClientSession(connector=TCPConnector(ssl=False, limit=concurrency)) as session:
+            ready = await wait_ready(session, url, workers)
+            print(f"{ready}/{workers} workers are ready.")
+
+            start = time.perf_counter()
+            await asyncio.gather(*(request(session) for _ in range(requests)))
+            elapsed = time.perf_counter() - start
+    finally:
+        await ApiServer.stop()
+        await Db.close()
+        Log.close()
+
+    latencies.sort()
+    print(f"{requests} requests in {elapsed:.2f}s, {requests / elapsed:.0f} req/s")
+    print(f"latency p50 {latencies[len(latencies) // 2] * 1000:.1f}ms, "
+          f"p95 {latencies[int(len(latencies) * 0.95)] * 1000:.1f}ms")
+    print(f"statuses: {dict(statuses)}")
+    print(f"served by workers: {dict(served_by)}")
+
+
+if __name__ == '__main__':
+    args = [int(i) for i in sys.argv[1:]]
+    asyncio.run(main(*(args + [4, 2000, 50][len(args):])))
@@ -0,0 +1,215 @@
+""" Local IPC between the bot process and the api worker processes over a unix socket """
+
+import os
+import json
+import asyncio
+import traceback
+from itertools import count
+
+from core import cfg, Log
+from .utils import ApiError, json_dumps
+
+
+class Ipc:
+    """
+    Bot process serves requests from the api workers with registered handlers (Ipc.handler decorator),
+    workers call them with Ipc.call(). The bot process can call handlers of every worker with Ipc.call_workers().
+    Both sides can Ipc.publish() events, events are delivered
+    to the Ipc.listener functions in every process (bot process relays events published by workers).
+    Messages are json lines:
+        {"id": int, "call": str, "kwargs": dict} -> {"id": int, "result": Any} or {"id": int, "error": [code, title, message]}
+        {"event": str, "data": dict}
+    """
+
+    path = getattr(cfg, 'API_IPC_SOCKET', 'lunodog.sock')
+    CALL_TIMEOUT = 5
+    LINE_LIMIT = 16 * 1024 * 1024
+
+    handlers = dict()  # {name: coroutine function}, served by the bot process
+    listeners = dict()  # {event: [functions]}
+
+    pending = dict()  # {request_id: Future}
+    seq = count()
+
+    # Bot process side
+    server = None
+    clients = set()  # StreamWriters of the connected workers
+
+    # Worker side
+    is_worker = False
+    reader = None
+    writer = None
+
+    @classmethod
+    def handler(cls, name: str):
+        def wrapper(coro):
+            cls.handlers[name] = coro
+            return coro
+        return wrapper
+
+    @classmethod
+    def listener(cls, event: str):
+        def wrapper(f):
+            cls.listeners.setdefault(event, []).append(f)
+            return f
+        return wrapper
+
+    @staticmethod
+    def encode(message: dict) -> bytes:
+        return json_dumps(message) + b'\n'
+
+    @classmethod
+    def dispatch(cls, event: str, data: dict):
+        for f in cls.listeners.get(event, []):
+            try:
+                f(**data)
+            except Exception as e:
+                Log.error(f"IPC| Error in {event} listener {f.__module__}.{f.__qualname__}: {e}")
+
+    @classmethod
+    def publish(cls, event: str, **data):
+        """ Run the event listeners in this and all other processes """
+
+        cls.dispatch(event, data)
+        if cls.is_worker:
+            if cls.writer is not None:
+                cls.writer.write(cls.encode({'event': event, 'data': data}))
+        else:
+            cls.broadcast(event, data)
+
+    @classmethod
+    def broadcast(cls, event: str, data: dict, exclude=None):
+        message = cls.encode({'event': event, 'data': data})
+        for writer in cls.clients:
+            if writer is not exclude:
+                writer.write(message)
+
+    # Bot process side
+
+    @classmethod
+    async def serve(cls):
+        if os.path.exists(cls.path):
+            os.remove(cls.path)
+        cls.server = await asyncio.start_unix_server(cls.handle_client, cls.path, limit=cls.LINE_LIMIT)
+        Log.info(f"IPC| Listening at {cls.path}")
+
+    @classmethod
+    async def handle_client(cls, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        cls.clients.add(writer)
+        try:
+            while line := await reader.readline():
+                message = json.loads(line)
+                if 'event' in message:  # Relay worker event to the bot and the other workers
+                    cls.dispatch(message['event'], message['data'])
+                    cls.broadcast(message['event'], message['data'], exclude=writer)
+                elif 'call' in message:
+                    asyncio.create_task(cls.handle_call(writer, message))
+                else:
+                    cls.resolve(message)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            cls.clients.discard(writer)
+            writer.close()
+
+    @classmethod
+    async def handle_call(cls, writer: asyncio.StreamWriter, message: dict):
+        try:
+            result = await cls.handlers[message['call']](**message.get('kwargs', {}))
+            reply = {'id': message['id'], 'result': result}
+        except ApiError as e:  # Passed to the api user as is
+            reply = {'id': message['id'], 'error': [e.code, e.title, e.message]}
+        except Exception as e:
+            Log.error(f"IPC| Error handling {message.get('call')} call: {e}\n{traceback.format_exc()}")
+            reply = {'id': message['id'], 'error': [500, 'Internal Server Error', str(e)]}
+        if not writer.is_closing():
+            writer.write(cls.encode(reply))
+
+    @classmethod
+    def resolve(cls, message: dict):
+        if (future := cls.pending.pop(message['id'], None)) is not None and not future.done():
+            if 'error' in message:
+                future.set_exception(ApiError(*message['error']))
+            else:
+                future.set_result(message['result'])
+
+    @classmethod
+    async def request(cls, writer: asyncio.StreamWriter, name: str, timeout: float | None, kwargs: dict):
+        request_id = next(cls.seq)
+        future = cls.pending[request_id] = asyncio.get_running_loop().create_future()
+        writer.write(cls.encode({'id': request_id, 'call': name, 'kwargs': kwargs}))
+        try:
+            return await asyncio.wait_for(future, timeout or cls.CALL_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise ApiError(503, 'Bot is unavailable.', 'Please try again later...')
+        finally:
+            cls.pending.pop(request_id, None)
+
+    @classmethod
+    async def call_workers(cls, name: str, timeout: float = None, **kwargs) -> list:
+        """ Call a handler in every api worker process, returns results of the workers which have answered """
+
+        results = await asyncio.gather(
+            *(cls.request(writer, name, timeout, kwargs) for writer in list(cls.clients)), return_exceptions=True
+        )
+        return [r for r in results if not isinstance(r, BaseException)]
+
+    @classmethod
+    async def close(cls):
+        if cls.server is not None:
+            cls.server.close()
+            await cls.server.wait_closed()
+            cls.server = None
+            if os.path.exists(cls.path):
+                os.remove(cls.path)
+        if cls.writer is not None:
+            cls.writer.close()
+            cls.writer = None
+
+    # Worker side
+
+    @classmethod
+    async def connect(cls):
+        """ Connect to the bot process, reconnects automatically if the connection is lost """
+
+        cls.is_worker = True
+        while True:
+            try:
+                cls.reader, cls.writer = await asyncio.open_unix_connection(cls.path, limit=cls.LINE_LIMIT)
+            except (ConnectionError, FileNotFoundError):
+                await asyncio.sleep(1)
+            else:
+                break
+        asyncio.create_task(cls.read_loop())
+
+    @classmethod
+    async def read_loop(cls):
+        try:
+            while line := await cls.reader.readline():
+                message = json.loads(line)
+                if 'event' in message:
+                    cls.dispatch(message['event'], message['data'])
+                elif 'call' in message:
+                    asyncio.create_task(cls.handle_call(cls.writer, message))
+                else:
+                    cls.resolve(message)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+
+        if cls.writer is None:  # Closed with Ipc.close()
+            return
+        Log.error("IPC| Connection to the bot process is lost, reconnecting...")
+        cls.reader = cls.writer = None
+        for future in cls.pending.values():
+            if not future.done():
+                future.set_exception(ApiError(503, 'Bot is unavailable.', 'Please try again later...'))
+        cls.pending.clear()
+        await cls.connect()
+
+    @classmethod
+    async def call(cls, name: str, timeout: float = None, **kwargs):
+        """ Call a handler in the bot process and return the result, timeout defaults to CALL_TIMEOUT seconds """
+
+        if cls.writer is None:
+            raise ApiError(503, 'Bot is unavailable.', 'Please try again later...')
+        return await cls.request(cls.writer, name, timeout, kwargs)
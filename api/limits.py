@@ -0,0 +1,38 @@
+import time
+from collections import OrderedDict
+
+
+class RateLimiter:
+    """
+    Token bucket per key, allows `rate` requests per second with bursts up to `burst` requests.
+    Above max_keys the least recently used buckets are dropped, they are full again most of the time.
+    """
+
+    def __init__(self, rate: float, burst: int, max_keys: int = 100000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self.buckets = OrderedDict()  # {key: [tokens, updated_at]}, least recently used first
+
+    def consume(self, key) -> float:
+        """ Take a token for the key, returns 0 on success or seconds to wait until a token is available """
+
+        now = time.monotonic()
+        if (bucket := self.buckets.get(key)) is None:
+            if len(self.buckets) >= self.max_keys:
+                self.buckets.popitem(last=False)
+            bucket = self.buckets[key] = [self.burst, now]
+        else:
+            self.buckets.move_to_end(key)
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            return 0
+        return (1 - bucket[0]) / self.rate
+
+
+def from_config(value: tuple[float, int] | None) -> RateLimiter | None:
+    """ Create a RateLimiter from (rate, burst) config value, None disables the limit """
+    return RateLimiter(*value) if value else None
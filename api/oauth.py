@@ -1,13 +1,20 @@
+import asyncio
+import hashlib
+import secrets
 from datetime import datetime, timedelta
-from aiohttp import ClientSession
+from types import SimpleNamespace
 from tortoise.models import Model
 from tortoise import fields
+from tortoise.transactions import in_transaction
 from discord import Guild
 
 from core import Db, cfg, Log, dc
-from core.utils import random_string
+from core.utils import TTLCache
 
 from .utils import ApiError
+from .discord_api import DiscordApi
+from .cache import ResponseCache
+from .ipc import Ipc
 
 oauth2_uri = 'https://discord.com/api/oauth2/token'
 identify_uri = 'https://discord.com/api/users/@me'
@@ -20,18 +27,41 @@ This module implements user authentication via discord oauth2 api. Steps:
 3. _oauth_verify confirms from discord API if the code is correct and receives user_data with user access_token.
 4. _oauth_fetch_user fetches user_data from the discord API (username, avatar, etc...) with the access_token.
 5. do_oauth generates user api_token, replaces or creates new user in the db oauth table.
+   Only sha256 hash of the api_token is stored in the db.
 6. api_token is passed back to the user for further interactions.
 Update user_data each time user_data['access_token'] is expired (@refresh_user decorator). 
 """
 
+# Authenticated users {api_token hash: OauthUser}, so authed requests don't need a db lookup
+user_cache = TTLCache(
+    max_size=getattr(cfg, 'API_USER_CACHE_SIZE', 4096),
+    ttl=getattr(cfg, 'API_USER_CACHE_TTL', 300)
+)
+# Running access_token refreshes {user_id: Future}
+refreshing = dict()
+# Access tokens expiring within REFRESH_MARGIN seconds are refreshed by the refresh_expiring() job
+REFRESH_MARGIN = 3600
+REFRESH_INTERVAL = 300
+REFRESH_CONCURRENCY = 8
+REFRESH_TIMEOUT = 30  # Api workers wait for the bot process refresh up to this many seconds
+# OauthUser fields updated by the access_token refresh
+REFRESHED_FIELDS = ['user_name', 'discriminator', 'avatar', 'access_token', 'refresh_token', 'expires_at']
+refresh_job_task = None
+
+# Guild ids of the users {user_id: frozenset of guild_ids}
+user_guilds_cache = TTLCache(
+    max_size=getattr(cfg, 'API_USER_CACHE_SIZE', 4096),
+    ttl=getattr(cfg, 'API_USER_CACHE_TTL', 300)
+)
+
 
 @Db.model
 class OauthUser(Model):
 
     class Meta:
-        __version__ = 1
+        __version__ = 2
     user_id = fields.BigIntField(pk=True)
-    api_token = fields.CharField(max_length=256)
+    api_token = fields.CharField(max_length=64, unique=True)  # sha256 hex digest of the api_token
     user_name = fields.CharField(max_length=256)
     discriminator = fields.CharField(max_length=256)
     avatar = fields.CharField(max_length=256)
@@ -44,29 +74,53 @@ class OauthUser(Model):
 class OauthUserGuild(Model):
 
     class Meta:
-        __version__ = 1
+        __version__ = 2
     user_id = fields.ForeignKeyField(model_name='default_app.OauthUser', related_name='guilds', on_delete='CASCADE')
-    guild_id = fields.BigIntField()
+    guild_id = fields.BigIntField(index=True)
+
+
+@Ipc.listener('user_changed')
+def forget_user(user_id: int, api_token: str = None):
+    """ Drop cached data of the user, this event is published to all api processes """
+    if api_token is not None:
+        user_cache.pop(api_token)
+    user_guilds_cache.pop(user_id)
+    ResponseCache.invalidate_user(user_id)
+
+
+def hash_token(api_token: str) -> str:
+    return hashlib.sha256(api_token.encode()).hexdigest()
 
 
-async def do_oauth(code: str) -> OauthUser:
+async def generate_token() -> str:
+    """ Generate new random api_token which hash is not in the db yet """
+    while await OauthUser.exists(api_token=hash_token(api_token := secrets.token_urlsafe(32))):
+        pass
+    return api_token
+
+
+async def do_oauth(code: str) -> tuple[OauthUser, str]:
+    """ Authenticate the user with the oauth2 code, returns the user and new api_token for the user """
+
     Log.info(f"API| Trying to auth a dc user with received oauth2 code '{code}'")
     oauth_data = await _oauth_verify(code, cfg.API_OAUTH_REDIRECT_URI, cfg.API_OAUTH_SCOPES)
     user_data = await _oauth_fetch_user(oauth_data['access_token'])
 
-    await OauthUser.filter(user_id=user_data['id']).delete()
+    if (old_user := await OauthUser.get_or_none(user_id=user_data['id'])) is not None:
+        Ipc.publish('user_changed', user_id=old_user.user_id, api_token=old_user.api_token)
+        await old_user.delete()
     oauth_user = OauthUser(
         user_id=user_data['id'],
         user_name=user_data['username'],
         discriminator=user_data['discriminator'],
         avatar=user_data['avatar'],
-        api_token=random_string(8),  # TODO: make sure this is unique
+        api_token=hash_token(api_token := await generate_token()),
         access_token=oauth_data['access_token'],
         refresh_token=oauth_data['refresh_token'],
         expires_at=datetime.now() + timedelta(seconds=oauth_data['expires_in'])
     )
     await oauth_user.save()
-    return oauth_user
+    return oauth_user, api_token
 
 
 async def _oauth_verify(oauth_code: str, redirect_uri: str, scopes: list[str]) -> dict:
@@ -86,20 +140,17 @@ async def _oauth_verify(oauth_code: str, redirect_uri: str, scopes: list[str]) -
     }
     headers = {'Content-Type': 'application/x-www-form-urlencoded'}
 
-    async with ClientSession() as session:
-        async with session.post(oauth2_uri, data=data, headers=headers) as resp:
-            # Response status should be 200 if oauth_code is legit
-            if resp.status != 200:
-                Log.error("API| Got invalid oauth2 code {}, got {} response code from discord api.".format(oauth_code,
-                                                                                                           resp.status))
-                raise ApiError(400, 'Bad Request', 'Failed to authenticate.')
-
-            oauth_data = await resp.json()
-            # Check the scopes are correct
-            if set(oauth_data['scope'].split(' ')) != set(scopes):
-                Log.error(
-                    "API| Invalid scope '{}' provided for oauth2 code '{}'".format(oauth_data['scope'], oauth_code))
-                raise ApiError(400, 'Bad Request', 'Invalid oauth2 scopes provided.')
+    status, oauth_data = await DiscordApi.request('POST', oauth2_uri, data=data, headers=headers)
+    # Response status should be 200 if oauth_code is legit
+    if status != 200:
+        Log.error("API| Got invalid oauth2 code {}, got {} response code from discord api.".format(oauth_code, status))
+        raise ApiError(400, 'Bad Request', 'Failed to authenticate.')
+
+    # Check the scopes are correct
+    if set(oauth_data['scope'].split(' ')) != set(scopes):
+        Log.error(
+            "API| Invalid scope '{}' provided for oauth2 code '{}'".format(oauth_data['scope'], oauth_code))
+        raise ApiError(400, 'Bad Request', 'Invalid oauth2 scopes provided.')
 
     # All good
     return oauth_data
@@ -116,64 +167,147 @@ async def _oauth_fetch_user(access_token) -> dict:
     """
 
     headers = {'Authorization': 'Bearer ' + access_token}
-    async with ClientSession() as session:
-        async with session.get(identify_uri, headers=headers) as resp:
-            if resp.status != 200:
-                Log.error(
-                    "API| Error fetching user identity for access_token '{}', got {} response code from discord api".format(
-                        access_token, resp.status))
-                raise ApiError(500, 'Discord API error', 'Error fetching user identity')
-            return await resp.json()
+    status, user_data = await DiscordApi.request('GET', identify_uri, headers=headers)
+    if status != 200:
+        Log.error(
+            "API| Error fetching user identity for access_token '{}', got {} response code from discord api".format(
+                access_token, status))
+        raise ApiError(500, 'Discord API error', 'Error fetching user identity')
+    return user_data
+
+
+async def _update_user(oauth_user: OauthUser) -> OauthUser:
+    """ Get new access_token with the refresh_token and update user data """
+
+    data = {
+        'client_id': cfg.DC_CLIENT_ID,
+        'client_secret': cfg.DC_CLIENT_SECRET,
+        'grant_type': 'refresh_token',
+        'refresh_token': oauth_user.refresh_token
+    }
+    headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+
+    status, oauth_data = await DiscordApi.request('POST', 'https://discord.com/api/v8/oauth2/token',
+                                                  data=data, headers=headers)
+    if status != 200:
+        Log.error(
+            'API| got invalid oauth2 refresh_token \'{}\', got {} response code from discord api'.format(
+                data['refresh_token'], status
+            ))
+        if status in (400, 401):  # The grant is revoked or expired, the user has to log in again
+            await forget_revoked_user(oauth_user)
+        raise ApiError(401, 'Bad Request', 'Failed to authenticate.')
+    user_data = await _oauth_fetch_user(oauth_data['access_token'])
+
+    # Confirm the user_ids are matching
+    if int(user_data['id']) != oauth_user.user_id:
+        Log.error('API| user_id mismatching @ \'{}\' refresh_token update, expected {} got {}.'.format(
+            data['refresh_token'], oauth_user.user_id, user_data['id']))
+        raise ApiError(401, 'Bad Request', 'Failed to authenticate.')
+
+    # Push to database, the object is updated in place so cached references stay valid
+    oauth_user.user_name = user_data['username']
+    oauth_user.discriminator = user_data['discriminator']
+    oauth_user.avatar = user_data['avatar']
+    oauth_user.access_token = oauth_data['access_token']
+    oauth_user.refresh_token = oauth_data['refresh_token']
+    oauth_user.expires_at = datetime.now() + timedelta(seconds=oauth_data['expires_in'])
+    # The user may have logged in again (new row with a new api_token) while the refresh was running,
+    # the refreshed grant must not overwrite the new one
+    if not await OauthUser.filter(user_id=oauth_user.user_id, api_token=oauth_user.api_token).update(
+        **{name: getattr(oauth_user, name) for name in REFRESHED_FIELDS}
+    ):
+        Log.info(f"API| User {oauth_user.user_id} has logged in again or was deleted during the token refresh.")
+        raise ApiError(401, 'Bad Request', 'Failed to authenticate.')
+    Ipc.publish('user_changed', user_id=oauth_user.user_id, api_token=oauth_user.api_token)
+    user_cache.set(oauth_user.api_token, oauth_user)
+    return oauth_user
+
+
+async def forget_revoked_user(oauth_user: OauthUser):
+    """ Delete the user with a permanently failing refresh_token, unless it has logged in again meanwhile """
+    Ipc.publish('user_changed', user_id=oauth_user.user_id, api_token=oauth_user.api_token)
+    await OauthUser.filter(user_id=oauth_user.user_id, api_token=oauth_user.api_token).delete()
+
+
+def _expires_within(oauth_user: OauthUser, seconds: float) -> bool:
+    expires_at = oauth_user.expires_at
+    now = datetime.now(expires_at.tzinfo) if expires_at.tzinfo else datetime.now()
+    return expires_at < now + timedelta(seconds=seconds)
+
+
+async def refresh_token(oauth_user: OauthUser) -> OauthUser:
+    """
+    Refresh user access_token, concurrent calls for the same user share a single discord api request.
+    Api worker processes ask the bot process to do it, as discord rotates the refresh_token on every use.
+    """
+
+    if (future := refreshing.get(oauth_user.user_id)) is None:
+        coro = _refresh_by_bot(oauth_user) if Ipc.is_worker else _update_user(oauth_user)
+        future = refreshing[oauth_user.user_id] = asyncio.ensure_future(coro)
+        future.add_done_callback(lambda f: refreshing.pop(oauth_user.user_id, None))
+    # Don't cancel the refresh if the awaiting request gets cancelled
+    return await asyncio.shield(future)
+
+
+async def _refresh_by_bot(oauth_user: OauthUser) -> OauthUser:
+    data = await Ipc.call('refresh_user', timeout=REFRESH_TIMEOUT, user_id=oauth_user.user_id)
+    data['expires_at'] = datetime.fromisoformat(data['expires_at'])
+    for name in REFRESHED_FIELDS:
+        setattr(oauth_user, name, data[name])
+    user_cache.set(oauth_user.api_token, oauth_user)
+    return oauth_user
+
+
+@Ipc.handler('refresh_user')
+async def _ipc_refresh_user(user_id: int) -> dict:
+    """ Refresh the user for an api worker, unless it is already refreshed by another process """
+
+    if (oauth_user := await OauthUser.get_or_none(user_id=user_id)) is None:
+        raise ApiError(400, 'API error', 'Bad api_token.')
+    if user_id in refreshing or _expires_within(oauth_user, 0):
+        oauth_user = await refresh_token(user_cache.get(oauth_user.api_token) or oauth_user)
+    data = {name: getattr(oauth_user, name) for name in REFRESHED_FIELDS}
+    data['expires_at'] = data['expires_at'].isoformat()
+    return data
+
+
+async def refresh_expiring():
+    """
+    Background job refreshing access_tokens which expire in REFRESH_MARGIN seconds,
+    so dashboard requests almost never have to wait for a token refresh.
+    """
+
+    global refresh_job_task
+    if refresh_job_task is not None and not refresh_job_task.done():
+        return  # Previous run is still in progress
+
+    async def refresh_all(oauth_users: list[OauthUser]):
+        semaphore = asyncio.Semaphore(REFRESH_CONCURRENCY)
+
+        async def refresh(oauth_user: OauthUser):
+            async with semaphore:
+                try:
+                    await refresh_token(user_cache.get(oauth_user.api_token) or oauth_user)
+                except ApiError:
+                    pass  # Already logged
+                except Exception as e:
+                    Log.error(f"API| Failed to refresh access_token for user {oauth_user.user_id}: {e}")
+
+        await asyncio.gather(*(refresh(u) for u in oauth_users))
+
+    oauth_users = await OauthUser.filter(expires_at__lt=datetime.now() + timedelta(seconds=REFRESH_MARGIN))
+    if len(oauth_users):
+        Log.info(f"API| Refreshing {len(oauth_users)} expiring access tokens.")
+        refresh_job_task = asyncio.create_task(refresh_all(oauth_users))
 
 
 def refresh_user(coro):
     """ This decorator refreshes user access_token and other data on demand (if token has expired) """
 
-    async def _update_user(oauth_user: OauthUser) -> OauthUser:
-        # Get new user data
-        data = {
-            'client_id': cfg.DC_CLIENT_ID,
-            'client_secret': cfg.DC_CLIENT_SECRET,
-            'grant_type': 'refresh_token',
-            'refresh_token': oauth_user.refresh_token
-        }
-        headers = {'Content-Type': 'application/x-www-form-urlencoded'}
-        Log.info(data)
-
-        async with ClientSession() as session:
-            async with session.post('https://discord.com/api/v8/oauth2/token', data=data, headers=headers) as resp:
-                if resp.status != 200:
-                    Log.error(
-                        'API| got invalid oauth2 refresh_token \'{}\', got {} response code from discord api'.format(
-                            data['refresh_token'], resp.status
-                        ))
-                    raise ApiError(401, 'Bad Request', 'Failed to authenticate.')
-                oauth_data = await resp.json()
-
-        # Confirm the user_ids are matching
-        if oauth_data['id'] != oauth_user.user_id:
-            Log.error('API| user_id mismatching @ \'{}\' refresh_token update, expected {} got {}.'.format(
-                data['refresh_token'], oauth_user.user_id, oauth_data['id']))
-            raise ApiError(401, 'Bad Request', 'Failed to authenticate.')
-
-        # Push to database
-
-        new_oauth_user = OauthUser(
-            user_id=oauth_data['id'],
-            user_name=oauth_data['username'],
-            discriminator=oauth_data['discriminator'],
-            avatar=oauth_data['avatar'],
-            api_token=oauth_user.api_token,
-            access_token=oauth_data['access_token'],
-            refresh_token=oauth_data['refresh_token'],
-            expires_at=datetime.now() + timedelta(seconds=oauth_data['expires_in'])
-        )
-        await new_oauth_user.save()
-        return new_oauth_user
-
     async def wrapper(oauth_user: OauthUser, *args, **kwargs):
-        if OauthUser.expires_at < datetime.now():
-            oauth_user = await _update_user(oauth_user)
+        if _expires_within(oauth_user, 0):
+            oauth_user = await refresh_token(oauth_user)
         return await coro(oauth_user, *args, **kwargs)
 
     return wrapper
@@ -188,37 +322,94 @@ async def fetch_user_guilds(oauth_user: OauthUser) -> list[Guild]:
     Returns list with discord.Guild objects.
     """
 
-    headers = {'Authorization': 'Bearer ' + oauth_user['access_token']}
-    async with ClientSession() as session:
-        async with session.get(guilds_uri, headers=headers) as resp:
-            if resp.status != 200:
-                Log.error(
-                    f"API| Error fetching guilds list for access_token '{oauth_user['access_token']}', resp.code {resp.status}"
-                )
-                raise ApiError(500, 'Discord API error', 'Error fetching guild list.')
-            guilds_data = await resp.json()
-
-    await oauth_user.guilds.all().delete()
-    await OauthUserGuild.bulk_create(
-        [OauthUserGuild(user_id=oauth_user.user_id, guild_id=int(g['id'])) for g in guilds_data]
-    )
+    headers = {'Authorization': 'Bearer ' + oauth_user.access_token}
+    status, guilds_data = await DiscordApi.request('GET', guilds_uri, headers=headers)
+    if status != 200:
+        Log.error(
+            f"API| Error fetching guilds list for access_token '{oauth_user.access_token}', resp.code {status}"
+        )
+        raise ApiError(500, 'Discord API error', 'Error fetching guild list.')
 
-    return [g for g in dc.guilds if g.id in [int(i['id']) for i in guilds_data]]
+    guild_ids = frozenset(int(g['id']) for g in guilds_data)
+    await sync_user_guilds(oauth_user, guild_ids)
+    user_guilds_cache.set(oauth_user.user_id, guild_ids)
+    return await get_guilds(guild_ids)
 
 
 async def get_user_guilds(oauth_user: OauthUser) -> list[Guild]:
-    """ Get user guilds from db (lazy method) """
+    """ Get user guilds from cache or db (lazy method) """
+
+    return await get_guilds(await get_user_guild_ids(oauth_user))
+
+
+async def get_user_guild_ids(oauth_user: OauthUser) -> frozenset[int]:
+    """ Get ids of all user guilds (including the ones without the bot) from cache or db """
+
+    if (guild_ids := user_guilds_cache.get(oauth_user.user_id)) is None:
+        guild_ids = frozenset(
+            await OauthUserGuild.filter(user_id_id=oauth_user.user_id).values_list('guild_id', flat=True)
+        )
+        user_guilds_cache.set(oauth_user.user_id, guild_ids)
+    return guild_ids
+
+
+async def sync_user_guilds(oauth_user: OauthUser, guild_ids: frozenset[int]) -> tuple[set[int], set[int]]:
+    """ Apply only the difference between stored and given user guilds to the db, returns (added, removed) ids """
+
+    async with in_transaction() as conn:
+        stored = set(
+            await OauthUserGuild.filter(user_id_id=oauth_user.user_id).using_db(conn).values_list('guild_id', flat=True)
+        )
+        added, removed = guild_ids - stored, stored - guild_ids
+        if len(removed):
+            await OauthUserGuild.filter(user_id_id=oauth_user.user_id, guild_id__in=removed).using_db(conn).delete()
+        if len(added):
+            await OauthUserGuild.bulk_create(
+                [OauthUserGuild(user_id_id=oauth_user.user_id, guild_id=guild_id) for guild_id in added],
+                using_db=conn
+            )
+    if len(added) or len(removed):
+        Ipc.publish('user_changed', user_id=oauth_user.user_id)
+    return added, removed
+
+
+async def get_guild_users(guild_id: int) -> list[int]:
+    """ Return user_ids of the dashboard users who are members of the guild (indexed lookup) """
+    return await OauthUserGuild.filter(guild_id=guild_id).values_list('user_id_id', flat=True)
+
+
+def resolve_guilds(guild_ids) -> list[Guild]:
+    """ Return Guild objects for the ids the bot is present in, dc.get_guild() is a dict lookup """
+    return [g for guild_id in guild_ids if (g := dc.get_guild(guild_id)) is not None]
+
+
+async def get_guilds(guild_ids) -> list[Guild | SimpleNamespace]:
+    """ Resolve guild ids, api worker processes ask the bot process and get guild_info() namespaces """
+    if Ipc.is_worker:
+        return [SimpleNamespace(**g) for g in await Ipc.call('guilds', guild_ids=list(guild_ids))]
+    return resolve_guilds(guild_ids)
+
+
+@Ipc.handler('guilds')
+async def _ipc_guilds(guild_ids: list[int]) -> list[dict]:
+    return [guild_info(g) for g in resolve_guilds(guild_ids)]
+
 
-    guild_ids = [i.guild_id for i in await oauth_user.guilds.all()]
-    return [g for g in dc.guilds if g.id in guild_ids]
+def guild_info(guild: Guild | SimpleNamespace) -> dict:
+    return {'id': guild.id, 'name': guild.name, 'icon': getattr(guild.icon, 'key', guild.icon)}
 
 
 async def get_user(api_token: str) -> OauthUser:
     """ Return oauth_user data for an api_token or raise an exception """
-    if (oauth_user := await OauthUser.get_or_none(api_token=api_token)) is None:
+    token_hash = hash_token(api_token)
+    if (oauth_user := user_cache.get(token_hash)) is not None:
+        return oauth_user
+    if (oauth_user := await OauthUser.get_or_none(api_token=token_hash)) is None:
         raise ApiError(400, 'API error', 'Bad api_token.')
+    user_cache.set(token_hash, oauth_user)
     return oauth_user
 
 
 async def delete_user(oauth_user: OauthUser) -> None:
+    Ipc.publish('user_changed', user_id=oauth_user.user_id, api_token=oauth_user.api_token)
     await oauth_user.delete()
@@ -0,0 +1,139 @@
+""" Server push of the config and guild changes to the dashboard users via WebSocket """
+
+import asyncio
+from urllib.parse import urlsplit
+from aiohttp import web
+
+from core import cfg, dc, Metrics
+from core.cfg_factory import CfgFactory
+from .utils import ApiError, json_dumps
+from .ipc import Ipc
+
+
+class PushHub:
+    """
+    Open dashboard WebSocket connections, indexed by the guilds of their users.
+    Notifications are published with Ipc, so every api process sends them to its own connections.
+    Messages are json objects like {"type": "config", "guild_id": int, ...}, the dashboard
+    is expected to refetch the data it needs.
+    Connections of a user are closed when the user guilds or the token change (user_changed event),
+    the dashboard reconnects and gets subscribed to the actual guilds.
+    """
+
+    # WebSocket upgrades are not covered by CORS, only the dashboard pages may open the connection with the cookie.
+    # Defaults to the origin of the oauth redirect page.
+    ALLOWED_ORIGINS = frozenset(getattr(cfg, 'API_DASHBOARD_ORIGINS', None) or [
+        '{0.scheme}://{0.netloc}'.format(urlsplit(cfg.API_OAUTH_REDIRECT_URI))
+    ])
+
+    MAX_CONNECTIONS = getattr(cfg, 'API_PUSH_MAX_CONNECTIONS', 1000)
+    MAX_PER_USER = getattr(cfg, 'API_PUSH_MAX_PER_USER', 5)
+    HEARTBEAT = getattr(cfg, 'API_PUSH_HEARTBEAT', 30)  # Seconds between pings, dead connections are closed
+    SEND_TIMEOUT = 5
+
+    user_connections = dict()  # {user_id: set of WebSocketResponse}
+    guild_connections = dict()  # {guild_id: set of WebSocketResponse}
+    expired = set()  # Connections to close right after the handshake
+    connections_metric = Metrics.gauge('api_push_connections', 'Open dashboard push connections.')
+    count = 0
+
+    @classmethod
+    async def serve(cls, request: web.Request, user_id: int, guild_ids: frozenset[int]) -> web.WebSocketResponse:
+        if request.headers.get('Origin') not in cls.ALLOWED_ORIGINS:
+            raise ApiError(403, 'Forbidden', 'Origin is not allowed.')
+        if cls.count >= cls.MAX_CONNECTIONS:
+            raise ApiError(503, 'Server is busy.', 'Too many open connections.', headers={'Retry-After': '30'})
+        if len(cls.user_connections.get(user_id, ())) >= cls.MAX_PER_USER:
+            raise ApiError(429, 'Too Many Requests', 'Too many open connections for the user.')
+
+        ws = web.WebSocketResponse(heartbeat=cls.HEARTBEAT, max_msg_size=4096)
+        cls.add(ws, user_id, guild_ids)  # Reserve the slot before the handshake, so concurrent ones see it
+        try:
+            await ws.prepare(request)
+            if ws in cls.expired:
+                await ws.close()
+            async for _ in ws:
+                pass  # Messages from the client are ignored, loop ends when the connection is closed
+        finally:
+            cls.remove(ws, user_id, guild_ids)
+        return ws
+
+    @classmethod
+    def add(cls, ws: web.WebSocketResponse, user_id: int, guild_ids: frozenset[int]):
+        cls.user_connections.setdefault(user_id, set()).add(ws)
+        for guild_id in guild_ids:
+            cls.guild_connections.setdefault(guild_id, set()).add(ws)
+        cls.count += 1
+        cls.connections_metric.set(value=cls.count)
+
+    @classmethod
+    def remove(cls, ws: web.WebSocketResponse, user_id: int, guild_ids: frozenset[int]):
+        for index, key in [(cls.user_connections, user_id), *((cls.guild_connections, i) for i in guild_ids)]:
+            if (connections := index.get(key)) is not None:
+                connections.discard(ws)
+                if not len(connections):
+                    del index[key]
+        cls.expired.discard(ws)
+        cls.count -= 1
+        cls.connections_metric.set(value=cls.count)
+
+    @classmethod
+    def close_user(cls, user_id: int):
+        for ws in cls.user_connections.get(user_id, ()):
+            if ws.prepared:
+                asyncio.create_task(ws.close(message=b'User data changed.'))
+            else:
+                cls.expired.add(ws)
+
+    @classmethod
+    async def send(cls, ws: web.WebSocketResponse, data: str):
+        try:
+            await asyncio.wait_for(ws.send_str(data), cls.SEND_TIMEOUT)
+        except (ConnectionError, RuntimeError, asyncio.TimeoutError):
+            await ws.close()
+
+    @classmethod
+    def notify(cls, guild_id: int, message: dict):
+        """ Send the message to local connections of the guild users """
+
+        if (connections := cls.guild_connections.get(guild_id)) is None:
+            return
+        data = json_dumps(message).decode()
+        for ws in list(connections):
+            if ws.prepared and not ws.closed:  # Skip the ones still in the handshake
+                asyncio.create_task(cls.send(ws, data))
+
+
+@Ipc.listener('user_changed')
+def on_user_changed(user_id: int, api_token: str = None):
+    PushHub.close_user(user_id)
+
+
+@Ipc.listener('push')
+def on_push(guild_id: int, message: dict):
+    PushHub.notify(guild_id, message)
+
+
+def on_config_change(factory, config, guild):
+    if guild is not None:
+        Ipc.publish('push', guild_id=guild.id, message={
+            'type': 'config', 'guild_id': guild.id, 'config': factory.name, 'cfg_id': config.row.cfg_id
+        })
+
+
+CfgFactory.listeners.append(on_config_change)
+
+
+@dc.event
+async def on_guild_join(guild):
+    Ipc.publish('push', guild_id=guild.id, message={'type': 'guild_join', 'guild_id': guild.id})
+
+
+@dc.event
+async def on_guild_remove(guild):
+    Ipc.publish('push', guild_id=guild.id, message={'type': 'guild_remove', 'guild_id': guild.id})
+
+
+@dc.event
+async def on_guild_update(before, after):
+    Ipc.publish('push', guild_id=after.id, message={'type': 'guild_update', 'guild_id': after.id})
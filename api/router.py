@@ -1,29 +1,66 @@
 from aiohttp import web
 import traceback
+import inspect
+import math
+import time
 import json
 
-from core import Log
+from core import Log, Metrics, cfg
 from modules.bot import Bot
 from . import ApiServer, oauth, ApiError
+from .cache import ResponseCache
+from .ipc import Ipc
+from . import limits
 
 
 class ApiRoute:
     """
     This class is a decorator for API route functions. It does:
         Register routes with '/api' prefix.
-        Prevent calling the function if connection to discord is not ready.
+        Reject requests over the per ip and per api_token rate limits or the global in-flight requests limit.
+        Prevent calling the function if connection to discord is not ready (unless ready=False is passed).
         Provide oauth_user if auth=True is passed.
         Provide post json data as kwargs.
+        Cache GET responses and answer conditional requests if cache=True is passed.
         Handle regular (ApiError) exceptions.
         Handle unexpected exceptions.
+        Count requests and measure latency per route.
+        Long-living connections (stream=True) are not counted as in-flight requests.
     """
 
-    def __init__(self, path, method='GET', auth=False):
+    requests_metric = Metrics.counter('api_requests_total', 'API requests.', ('method', 'route', 'status'))
+    latency_metric = Metrics.histogram('api_request_duration_seconds', 'API requests latency.', ('method', 'route'))
+    rejected_metric = Metrics.counter('api_rejected_total', 'API requests rejected by the limits.', ('reason', ))
+    inflight_metric = Metrics.gauge('api_inflight_requests', 'API requests being processed.')
+
+    # Limits, rate limits are configured as (requests per second, burst) tuples.
+    # All limits are per process: with API_WORKERS the effective limits are API_WORKERS times higher.
+    # Behind a reverse proxy request.remote is the proxy address, so the ip limit is shared by all clients.
+    max_inflight = getattr(cfg, 'API_MAX_INFLIGHT', 256)
+    ip_limiter = limits.from_config(getattr(cfg, 'API_RATE_LIMIT_IP', (20, 60)))
+    token_limiter = limits.from_config(getattr(cfg, 'API_RATE_LIMIT_TOKEN', (10, 30)))
+    inflight = 0
+
+    # Bot state as seen by the api worker processes
+    bot_ready = False
+    bot_ready_checked_at = 0
+
+    def __init__(self, path, method='GET', auth=False, cache=False, ready=True, stream=False):
         self.path = path
         self.method = method
         self.auth = auth
+        self.cache = cache and method == 'GET'
+        self.ready = ready
+        self.stream = stream
 
     def __call__(self, coro):
+        # Query parameters the route function takes, others are ignored by the response cache (None for **kwargs)
+        params = inspect.signature(coro).parameters.values()
+        if any(p.kind is p.VAR_KEYWORD for p in params):
+            self.query_params = None
+        else:
+            self.query_params = frozenset(p.name for p in params) - {'request', 'oauth_user'}
+
         async def decorator(request):
             return await self.wrapper(request, coro)
 
@@ -31,21 +68,48 @@ class ApiRoute:
         ApiServer.app.router.add_route(self.method, '/api' + self.path, decorator)
         return decorator
 
-    # Main function
     async def wrapper(self, request: web.Request, coro):
+        start = time.perf_counter()
+        if (error := self.check_limits(request)) is not None:
+            self.rejected_metric.inc(error.code)
+            response = error.web_response()
+        elif self.stream:
+            response = await self.handle(request, coro)
+        else:
+            ApiRoute.inflight += 1
+            self.inflight_metric.set(value=ApiRoute.inflight)
+            try:
+                response = await self.handle(request, coro)
+            finally:
+                ApiRoute.inflight -= 1
+                self.inflight_metric.set(value=ApiRoute.inflight)
+        self.requests_metric.inc(self.method, self.path, response.status)
+        if not self.stream:
+            self.latency_metric.observe(time.perf_counter() - start, self.method, self.path)
+        return response
+
+    # Main function
+    async def handle(self, request: web.Request, coro):
         # Check if the bot is ready to process api requests.
-        if not Bot.bot_ready:
+        if self.ready and not await self.is_bot_ready():
             return ApiError(code=503, title="Bot is under connection.",
                             message="Please try again later...").web_response()
 
         # Prepare kwargs and run the function
         try:
-            kwargs = await self.get_post_data(request) if self.method == 'POST' else dict(request.query)
+            if self.method == 'POST':
+                kwargs = await self.get_post_data(request)
+            elif self.cache and self.query_params is not None:
+                kwargs = {name: value for name, value in request.query.items() if name in self.query_params}
+            else:
+                kwargs = dict(request.query)
 
             if self.auth:
                 kwargs['oauth_user'] = await self.get_oauth_user(request)
 
-            Log.info(f"Running {coro.__name__}...")
+            if self.cache:
+                return await self.run_cached(request, coro, kwargs)
+
             return await coro(request, **kwargs)
 
         # Catch regular exceptions
@@ -62,6 +126,65 @@ class ApiRoute:
             ]))
             return ApiError(code=500, title="Internal Server Error", message="Unknown API error.").web_response()
 
+    async def run_cached(self, request: web.Request, coro, kwargs: dict):
+        """ Return cached response or 304 if the client has it, run the route function on cache miss """
+
+        user_id = kwargs['oauth_user'].user_id if self.auth else None
+        query = request.query.items()
+        if self.query_params is not None:
+            query = ((name, value) for name, value in query if name in self.query_params)
+        key = (self.path, tuple(sorted(query)))
+        if_none_match = request.headers.get('If-None-Match')
+
+        if (cached := ResponseCache.get(user_id, key)) is not None:
+            etag, body = cached
+            if (matched := ResponseCache.etag_matches(if_none_match, etag)) is not None:
+                return ResponseCache.response(matched)
+            return ResponseCache.response(etag, body)
+
+        # The handler has to run on a cache miss, the etag is known only after that
+        response = await coro(request, **kwargs)
+        if response.status != 200 or type(response.body) is not bytes or len(response.cookies):
+            return response
+
+        etag = ResponseCache.set(user_id, key, response.body)
+        if (matched := ResponseCache.etag_matches(if_none_match, etag)) is not None:
+            return ResponseCache.response(matched)
+        response.headers['ETag'] = etag
+        return response
+
+    def check_limits(self, request: web.Request) -> ApiError | None:
+        """ Return ApiError if the request must be rejected, this is cheap and done before anything else """
+
+        if not self.stream and self.max_inflight and self.inflight >= self.max_inflight:
+            return ApiError(503, 'Server is busy.', 'Please try again later...', headers={'Retry-After': '1'})
+
+        if self.ip_limiter is not None and (delay := self.ip_limiter.consume(request.remote)):
+            return ApiError(429, 'Too Many Requests', 'Rate limit exceeded.',
+                            headers={'Retry-After': str(math.ceil(delay))})
+
+        if (
+            self.token_limiter is not None and
+            (api_token := request.cookies.get('api_token')) is not None and
+            (delay := self.token_limiter.consume(api_token))
+        ):
+            return ApiError(429, 'Too Many Requests', 'Rate limit exceeded.',
+                            headers={'Retry-After': str(math.ceil(delay))})
+
+    @classmethod
+    async def is_bot_ready(cls) -> bool:
+        """ Api worker processes ask the bot process, at most once per second """
+
+        if not Ipc.is_worker:
+            return Bot.bot_ready
+        if time.monotonic() - cls.bot_ready_checked_at > 1:
+            try:
+                cls.bot_ready = await Ipc.call('bot_ready')
+            except ApiError:
+                cls.bot_ready = False
+            cls.bot_ready_checked_at = time.monotonic()
+        return cls.bot_ready
+
     @staticmethod
     async def get_post_data(request):
         try:
@@ -76,3 +199,8 @@ class ApiRoute:
         if (api_token := request.cookies.get('api_token')) is None:
             raise ApiError(401, 'Not authorized', 'api_token is missing.')
         return await oauth.get_user(api_token)
+
+
+@Ipc.handler('bot_ready')
+async def _ipc_bot_ready() -> bool:
+    return Bot.bot_ready
@@ -1,6 +1,8 @@
-from aiohttp.web import Request
+from aiohttp.web import Request, Response
 
-from . import ApiRoute, ApiError, api_success, oauth
+from core import cfg, Profiler, Metrics
+from . import ApiRoute, ApiError, api_success, oauth, ApiServer, PushHub
+from .ipc import Ipc
 
 
 @ApiRoute('/test', method='GET', auth=False)
@@ -17,9 +19,9 @@ async def do_oauth(request: Request, code=None):
     if code is None:
         raise ApiError(code=400, title='Bad Request', message='Oauth2 code is missing in the request.')
 
-    oauth_user = await oauth.do_oauth(code)
+    oauth_user, api_token = await oauth.do_oauth(code)
     response = api_success()
-    response.set_cookie('api_token', oauth_user.api_token, samesite=None, secure=True)
+    response.set_cookie('api_token', api_token, samesite=None, secure=True)
     return response
 
 
@@ -28,15 +30,58 @@ async def test_authed(request: Request, oauth_user: oauth.OauthUser):
     return api_success({'success': f'Authed as {oauth_user.user_name}'})
 
 
-@ApiRoute('/get_user', method='GET', auth=True)
+@ApiRoute('/get_user', method='GET', auth=True, cache=True)
 async def get_user(request: Request, oauth_user: oauth.OauthUser):
     return api_success({
         'id': oauth_user.user_id,
         'name': oauth_user.user_name,
         'discriminator': oauth_user.discriminator,
         'avatar': oauth_user.avatar,
-        'guilds': [
-            {'id': g.id, 'name': g.name, 'icon': g.icon}
-            for g in await oauth.get_user_guilds(oauth_user)
-        ]
+        'guilds': [oauth.guild_info(g) for g in await oauth.get_user_guilds(oauth_user)]
     })
+
+
+# WebSocket streaming {"type": str, "guild_id": int, ...} change notifications for the user guilds
+@ApiRoute('/push', method='GET', auth=True, stream=True)
+async def push(request: Request, oauth_user: oauth.OauthUser):
+    return await PushHub.serve(request, oauth_user.user_id, await oauth.get_user_guild_ids(oauth_user))
+
+
+@ApiRoute('/profiler', method='GET', auth=True)
+async def profiler(request: Request, oauth_user: oauth.OauthUser):
+    if oauth_user.user_id not in getattr(cfg, 'API_ADMINS', []):
+        raise ApiError(code=403, title='Forbidden', message='This route is only available for the bot admins.')
+    # Background tasks run in the bot process only
+    return api_success(await Ipc.call('profiler') if Ipc.is_worker else profiler_stats())
+
+
+@Ipc.handler('profiler')
+async def _ipc_profiler() -> dict:
+    return profiler_stats()
+
+
+def profiler_stats() -> dict:
+    return {'budget': Profiler.BUDGET * 1000, 'tasks': Profiler.stats()}
+
+
+# Prometheus metrics, protected with 'Authorization: Bearer {API_METRICS_TOKEN}' header if the token is set.
+# Metrics of the bot process and of every api worker process (with the worker label) are served together.
+@ApiRoute('/metrics', method='GET', auth=False, ready=False)
+async def metrics(request: Request):
+    if (token := getattr(cfg, 'API_METRICS_TOKEN', None)) and request.headers.get('Authorization') != f"Bearer {token}":
+        raise ApiError(code=401, title='Not authorized', message='Bad metrics token.')
+    collected = await Ipc.call('metrics', timeout=10) if Ipc.is_worker else await _ipc_metrics()
+    return Response(
+        body=Metrics.format(*collected).encode(),
+        headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+    )
+
+
+@Ipc.handler('metrics')
+async def _ipc_metrics() -> list[dict]:
+    return [Metrics.collect(), *await Ipc.call_workers('worker_metrics')]
+
+
+@Ipc.handler('worker_metrics')
+async def _ipc_worker_metrics() -> dict:
+    return Metrics.collect({'worker': ApiServer.worker_id})
@@ -1,15 +1,80 @@
 # -*- coding: utf-8 -*-
+import os
 import ssl
+import gzip
+import asyncio
+import multiprocessing
 from aiohttp_middlewares import cors_middleware
 from aiohttp import web
 
-from core import cfg, Log
+from core import cfg, Log, Scheduler, Db
+from .discord_api import DiscordApi
+from .ipc import Ipc
+
+try:
+    import brotli
+except ModuleNotFoundError:
+    brotli = None
+
+COMPRESS_MIN_SIZE = getattr(cfg, 'API_COMPRESS_MIN_SIZE', 1024)  # Smaller responses are sent uncompressed
+COMPRESS_EXECUTOR_SIZE = 256 * 1024  # Larger responses are compressed in a thread
+
+
+def accepted_encodings(header: str) -> set[str]:
+    """ Content-codings from the Accept-Encoding header, except the ones with q=0 """
+
+    accepted = set()
+    for item in header.split(','):
+        coding, *params = item.split(';')
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if q > 0 and (coding := coding.strip().lower()):
+            accepted.add(coding)
+    return accepted
+
+
+@web.middleware
+async def compression_middleware(request: web.Request, handler):
+    """ Compress json responses with brotli (if installed) or gzip, depending on the Accept-Encoding header """
+
+    response = await handler(request)
+    if (
+        type(response) is not web.Response or
+        type(body := response.body) is not bytes or
+        len(body) < COMPRESS_MIN_SIZE or
+        'Content-Encoding' in response.headers
+    ):
+        return response
+
+    accepted = accepted_encodings(request.headers.get('Accept-Encoding', ''))
+    if brotli is not None and 'br' in accepted:
+        encoding, compress = 'br', lambda b: brotli.compress(b, quality=4)
+    elif 'gzip' in accepted:
+        encoding, compress = 'gzip', lambda b: gzip.compress(b, compresslevel=5)
+    else:
+        return response
+
+    if len(body) >= COMPRESS_EXECUTOR_SIZE:
+        response.body = await asyncio.get_running_loop().run_in_executor(None, compress, body)
+    else:
+        response.body = compress(body)
+    response.headers['Content-Encoding'] = encoding
+    if (etag := response.headers.get('ETag')) is not None:
+        response.headers['ETag'] = f'{etag[:-1]}-{encoding}"'  # Strong etag must differ for every content-coding
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
 
 
 class ApiServer:
 
     app = web.Application(
-        middlewares=[cors_middleware(allow_all=True, allow_credentials=True)]
+        middlewares=[cors_middleware(allow_all=True, allow_credentials=True), compression_middleware]
     )
     runner = web.AppRunner(app)
 
@@ -21,9 +86,56 @@ class ApiServer:
         keyfile=cfg.API_SSL_KEY_FILE
     )
 
+    workers = []  # Api worker processes
+    worker_id = None  # Set inside of an api worker process
+
     @classmethod
-    async def start(cls):
+    async def start(cls, workers: int = None):
+        """
+        Serve the api from the bot process, or spawn api worker processes sharing the port with SO_REUSEPORT
+        if API_WORKERS > 0. Workers access the bot data (dc) via Ipc.
+        Workers need a database server, with sqlite the api is always served from the bot process.
+        """
+        from .oauth import refresh_expiring, REFRESH_INTERVAL
+        from .worker import run_worker
+
+        await DiscordApi.start()
+        Scheduler.call_every(REFRESH_INTERVAL, refresh_expiring)
+
+        workers = getattr(cfg, 'API_WORKERS', 0) if workers is None else workers
+        if workers > 0 and Db.dialect() == 'sqlite':
+            Log.error("API| API_WORKERS is not supported with the sqlite database, serving from the bot process.")
+            workers = 0
+        if workers <= 0:
+            await cls.serve()
+            return
+
+        await Ipc.serve()
+        ctx = multiprocessing.get_context('spawn')
+        for i in range(workers):
+            os.environ['LUNODOG_WORKER'] = str(i)
+            process = ctx.Process(target=run_worker, args=(i,), name=f"api_worker{i}", daemon=True)
+            process.start()
+            cls.workers.append(process)
+        os.environ.pop('LUNODOG_WORKER', None)
+        Log.info(f'API| Started {workers} api worker processes.')
+
+    @classmethod
+    async def serve(cls, reuse_port: bool = False):
         await cls.runner.setup()
-        site = web.TCPSite(cls.runner, cfg.API_HOST, cfg.API_PORT, ssl_context=cls.context)
+        site = web.TCPSite(cls.runner, cfg.API_HOST, cfg.API_PORT, ssl_context=cls.context,
+                           reuse_port=reuse_port or None)
         await site.start()
         Log.info(f'API| Serving at https://{cfg.API_HOST}:{cfg.API_PORT}')
+
+    @classmethod
+    async def stop(cls):
+        for process in cls.workers:
+            process.terminate()
+        for process in cls.workers:
+            await asyncio.get_running_loop().run_in_executor(None, process.join, 5)
+        cls.workers = []
+        await Ipc.close()
+        if cls.runner.server is not None:
+            await cls.runner.cleanup()
+        await DiscordApi.close()
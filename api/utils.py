@@ -1,19 +1,45 @@
 from aiohttp.web import Response
 import json
 
+try:
+    import orjson
+except ModuleNotFoundError:
+    orjson = None
+
+
+def stdlib_dumps(data) -> bytes:
+    return json.dumps(data).encode()
+
+
+def orjson_dumps(data) -> bytes:
+    return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+
+
+# Serializer used for all api responses, orjson if it is installed
+json_dumps = orjson_dumps if orjson is not None else stdlib_dumps
+
+
+def set_json_serializer(dumps: callable):
+    """ Replace api responses serializer, dumps(data) must return bytes """
+    global json_dumps
+    json_dumps = dumps
+
 
 class ApiError(Exception):
 
-    def __init__(self, code=500, title="Internal Server Error", message="There was an error processing the request."):
+    def __init__(self, code=500, title="Internal Server Error", message="There was an error processing the request.",
+                 headers: dict = None):
         self.code = code
         self.title = title
         self.message = message
+        self.headers = headers
 
     def web_response(self):
         return Response(
             status=self.code,
             content_type='application/json',
-            body=json.dumps({'error': {'status': self.title, 'message': self.message}})
+            body=json_dumps({'error': {'status': self.title, 'message': self.message}}),
+            headers=self.headers
         )
 
 
@@ -22,5 +48,5 @@ def api_success(data=None):
     return Response(
         status=200,
         content_type='application/json',
-        body=json.dumps({'status': 'ok'} if data is None else data)
+        body=json_dumps({'status': 'ok'} if data is None else data)
     )
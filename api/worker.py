@@ -0,0 +1,40 @@
+""" Api worker process, serves the api on the port shared with SO_REUSEPORT and talks to the bot process via Ipc """
+
+import asyncio
+import signal
+
+from core import Db, Log
+from .server import ApiServer
+from .ipc import Ipc
+from .discord_api import DiscordApi
+
+
+def run_worker(worker_id: int):
+    """ Worker process entry point """
+    asyncio.run(main(worker_id))
+
+
+async def add_worker_header(request, response):
+    response.headers['X-Api-Worker'] = str(ApiServer.worker_id)
+
+
+async def main(worker_id: int):
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    ApiServer.worker_id = worker_id
+    ApiServer.app.on_response_prepare.append(add_worker_header)
+    await Db.connect()
+    await Ipc.connect()
+    await DiscordApi.start()
+    await ApiServer.serve(reuse_port=True)
+    Log.info(f"API| Worker {worker_id} is ready.")
+
+    await stop.wait()
+    await ApiServer.runner.cleanup()
+    await DiscordApi.close()
+    await Ipc.close()
+    await Db.close()
+    Log.close()
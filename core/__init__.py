@@ -1,18 +1,26 @@
 from . import utils
 from .config import cfg
 from .console import Console, Log
+from .profiler import Profiler
+from .metrics import Metrics
+from .scheduler import Scheduler
 from .database import Database as Db
 from . import cfg_factory
 from .client import dc
+from .guild_index import GuildIndex
 
 """
 This package provides core functionality of the bot:
     - bot configuration access: cfg
     - console interface: Console
     - logging: Log
+    - background tasks scheduling: Scheduler
+    - background tasks timings: Profiler
+    - application metrics: Metrics
     - database access: Db
     - database tables versioning and migrations
     - user configs system: cfg_factory
     - discord client access: dc
     - event system: dc.event
+    - guild roles/channels/emojis name lookups: GuildIndex
 """
\ No newline at end of file
@@ -2,12 +2,16 @@
 from __future__ import annotations
 
 import json
+import asyncio
+from collections import OrderedDict
 from typing import Any
 from types import SimpleNamespace
 from tortoise import Model, fields
+from tortoise.transactions import in_transaction
 from nextcord import Guild
 
-from core import Db, Log
+from core import Db, Log, cfg
+from core.client import dc
 
 
 class ConfigTable(Model):
@@ -21,6 +25,14 @@ class ConfigTable(Model):
 
 class CfgFactory:
 
+    SPAWN_CHUNK_SIZE = 500  # Max number of cfg_ids in a single spawn_many() query
+    SPAWN_CONCURRENCY = 64  # Max number of configs being wrapped at the same time in spawn_many()
+    FLUSH_INTERVAL = getattr(cfg, 'CFG_FLUSH_INTERVAL', 5)  # Seconds between write-behind flushes
+
+    factories = []  # All created factories, used to flush write-behind configs
+    listeners = []  # Callables called as f(factory, config, guild) after any config update or delete
+    last_flush = 0
+
     def __init__(
         self,
         name: str,
@@ -28,12 +40,18 @@ class CfgFactory:
         display: str = None,  # How config will be shown in the UI
         icon: str = None,  # Icon path for the UI
         table_name: str = None,  # Useful in case you need to use single table for different class objects configs
+        # Max number of live Config objects kept in memory, 0 disables the cache, None for unbounded cache
+        # (for the per-guild configs, so all the bot guilds stay warm after spawn_many())
+        cache_size: int | None = 1024,
+        write_behind: bool = False,  # Save updated configs to the db in batches from the background loop
+        lazy: bool = False,  # Wrap variables on first attribute access instead of on spawn
     ):
 
         self.name = name
         self.display = display or name
         self.icon = icon or 'default'
         self.variables = {v.name: v for v in variables}
+        self.lazy = lazy
 
         # Generate tortoise Model class for this CfgFactory and save it inside this class object
         @Db.model
@@ -44,12 +62,233 @@ class CfgFactory:
 
         self.table = _ConfigTable
 
+        # LRU cache of live Config objects {cfg_id: Config}
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+        # Updated configs waiting for the write-behind flush {cfg_id: Config}
+        self.write_behind = write_behind
+        self.dirty = dict()
+
+        CfgFactory.factories.append(self)
+
     async def spawn(self, guild: Guild, cfg_id: int) -> Config:
-        """ Load or create default config with given cfg_id """
+        """
+        Load or create default config with given cfg_id.
+        Variables of a cached config are resolved again if it was spawned with another guild object.
+        """
+
+        if (config := self.cache.get(cfg_id)) is not None:
+            self.cache.move_to_end(cfg_id)
+            self.cache_hits += 1
+            if config._guild is not guild:
+                await config.rewrap(guild)
+            return config
+        self.cache_misses += 1
+
+        # Evicted from the cache but not saved yet, the db row is outdated
+        if (config := self.dirty.get(cfg_id)) is not None:
+            self.cache_put(config)
+            await config.rewrap(guild)
+            return config
 
         if (row := await self.table.get_or_none(cfg_name=self.name, cfg_id=cfg_id)) is not None:
-            return await Config.new(self, guild, row)
-        return await Config.new(self, guild, self.table(cfg_id=cfg_id, cfg_name=self.name))
+            config = await Config.new(self, guild, row)
+        else:
+            config = await Config.new(self, guild, self.table(cfg_id=cfg_id, cfg_name=self.name))
+
+        # Another spawn() with the same cfg_id could have finished while we were awaiting, keep the first one live
+        if (cached := self.cache.get(cfg_id)) is not None:
+            return cached
+        self.cache_put(config)
+        return config
+
+    async def spawn_many(self, targets: list[tuple[Guild, int]]) -> dict[int, Config]:
+        """
+        Load or create default configs for a list of (guild, cfg_id) pairs.
+        Rows are fetched with one query per SPAWN_CHUNK_SIZE cfg_ids instead of one query per config.
+        Only the last cache_size configs stay in the cache, warming more of them needs a larger cache_size.
+        Returns {cfg_id: Config} dict.
+        """
+
+        if self.cache_size is not None and len(targets) > self.cache_size:
+            Log.info(
+                f"Spawning {len(targets)} {self.name} configs, only {self.cache_size} will be cached (cache_size)."
+            )
+
+        configs = dict()
+        missing = dict()
+        stale = []  # (config, guild) pairs to resolve against the given guild again
+        for guild, cfg_id in targets:
+            if (config := self.cache.get(cfg_id)) is not None:
+                self.cache.move_to_end(cfg_id)
+                self.cache_hits += 1
+                configs[cfg_id] = config
+                if config._guild is not guild:
+                    stale.append((config, guild))
+            elif (config := self.dirty.get(cfg_id)) is not None:
+                self.cache_put(config)
+                configs[cfg_id] = config
+                stale.append((config, guild))
+            else:
+                missing[cfg_id] = guild
+        self.cache_misses += len(missing)
+
+        rows = dict()
+        cfg_ids = list(missing.keys())
+        for i in range(0, len(cfg_ids), self.SPAWN_CHUNK_SIZE):
+            chunk = cfg_ids[i:i + self.SPAWN_CHUNK_SIZE]
+            rows.update({
+                row.cfg_id: row for row in await self.table.filter(cfg_name=self.name, cfg_id__in=chunk)
+            })
+
+        semaphore = asyncio.Semaphore(self.SPAWN_CONCURRENCY)
+
+        async def rewrap(config: Config, guild: Guild):
+            async with semaphore:
+                await config.rewrap(guild)
+
+        async def wrap(cfg_id: int, guild: Guild) -> Config:
+            async with semaphore:
+                row = rows.get(cfg_id) or self.table(cfg_id=cfg_id, cfg_name=self.name)
+                return await Config.new(self, guild, row)
+
+        await asyncio.gather(*(rewrap(config, guild) for config, guild in stale))
+
+        for config in await asyncio.gather(*(wrap(cfg_id, guild) for cfg_id, guild in missing.items())):
+            cfg_id = config.row.cfg_id
+            if (cached := self.cache.get(cfg_id)) is not None:
+                configs[cfg_id] = cached
+            else:
+                self.cache_put(config)
+                configs[cfg_id] = config
+
+        return configs
+
+    def cache_put(self, config: Config):
+        """ Put a live config to the cache, evicting least recently used ones if the cache is full """
+
+        if self.cache_size is not None and self.cache_size <= 0:
+            return
+        self.cache[config.row.cfg_id] = config
+        self.cache.move_to_end(config.row.cfg_id)
+        while self.cache_size is not None and len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def invalidate(self, cfg_id: int):
+        """ Drop config with given cfg_id from the cache """
+        self.cache.pop(cfg_id, None)
+
+    @classmethod
+    def invalidate_guild(cls, guild_id: int):
+        """ Drop cached configs of the guild from all factories, so next spawn() resolves roles and channels again """
+        cls.invalidate_where(lambda guild: guild.id == guild_id)
+
+    @classmethod
+    def invalidate_where(cls, predicate: callable):
+        """ Drop cached configs from all factories if predicate(config guild) is true """
+
+        for factory in cls.factories:
+            for cfg_id in [
+                cfg_id for cfg_id, config in factory.cache.items()
+                if config._guild is not None and predicate(config._guild)
+            ]:
+                del factory.cache[cfg_id]
+
+    @classmethod
+    async def think(cls, frame_time: float):
+        """ Flush write-behind configs every FLUSH_INTERVAL seconds, this should be called from the background loop """
+
+        # Wall clock time may step backwards (NTP corrections), the flushes must not stop until it catches up
+        if not 0 <= frame_time - cls.last_flush < cls.FLUSH_INTERVAL:
+            cls.last_flush = frame_time
+            await cls.flush()
+
+    @classmethod
+    async def flush(cls):
+        """ Save all dirty configs of all factories in a single transaction """
+
+        configs = []
+        for factory in cls.factories:
+            configs.extend(factory.dirty.values())
+            factory.dirty = dict()  # Configs updated during the flush will be marked dirty again
+        if not len(configs):
+            return
+
+        # Remember what was pending in case the transaction gets rolled back
+        pending = [(config, config._dirty, config.row._saved_in_db) for config in configs]
+        try:
+            async with in_transaction() as conn:
+                for config in configs:
+                    await config.save(using_db=conn)
+        except Exception as e:
+            Log.error(f"Failed to flush {len(configs)} configs to the db: {e}")
+            for config, names, saved_in_db in pending:
+                config._dirty |= names
+                config.row._saved_in_db = saved_in_db
+                config._factory.dirty.setdefault(config.row.cfg_id, config)
+        else:
+            Log.debug(f"Flushed {len(configs)} configs to the db.")
+
+    def cache_info(self) -> dict:
+        return dict(
+            size=len(self.cache),
+            max_size=self.cache_size,
+            hits=self.cache_hits,
+            misses=self.cache_misses
+        )
+
+
+# Dialects the partial cfg_data updates are used with, the others save the whole cfg_data.
+# Add 'mysql' (MySQL or MariaDB) or 'postgres' after python -m core.cfg_factory.json_check {db_url} passes on the server.
+JSON_UPDATE_DIALECTS = frozenset(getattr(cfg, 'CFG_JSON_UPDATE_DIALECTS', ['sqlite']))
+
+
+def json_update_query(dialect: str, table: str, cfg_id: int, data: dict) -> tuple[str, list] | None:
+    """
+    Build (sql, values) setting only the given keys of the "cfg_data" json column of the config row,
+    or return None if it is not supported for the dialect ('postgres' means asyncpg) or the key names.
+    Run python -m core.cfg_factory.json_check to verify the queries on a database.
+    """
+
+    names = sorted(data.keys())
+    if any('"' in name or '\\' in name for name in names):  # Would need json path escaping
+        return None
+    paths = [f'$."{name}"' for name in names]
+    values = [json.dumps(data[name]) for name in names]
+
+    match dialect:
+        case 'sqlite':
+            args = ', '.join('?, json(?)' for _ in names)
+            sql = f'UPDATE "{table}" SET "cfg_data" = json_set("cfg_data", {args}) WHERE "cfg_id" = ?'
+            params = [i for pair in zip(paths, values) for i in pair]
+        case 'mysql':
+            args = ', '.join("%s, JSON_EXTRACT(%s, '$')" for _ in names)  # CAST AS JSON is missing on MariaDB
+            sql = f'UPDATE `{table}` SET `cfg_data` = JSON_SET(`cfg_data`, {args}) WHERE `cfg_id` = %s'
+            params = [i for pair in zip(paths, values) for i in pair]
+        case 'postgres':
+            expr = '"cfg_data"'
+            for i in range(len(names)):
+                expr = f'jsonb_set({expr}, ${i * 2 + 1}::text[], ${i * 2 + 2}::jsonb)'
+            sql = f'UPDATE "{table}" SET "cfg_data" = {expr} WHERE "cfg_id" = ${len(names) * 2 + 1}'
+            params = [i for pair in zip([[name] for name in names], values) for i in pair]
+        case _:
+            return None
+
+    return sql, params + [cfg_id]
+
+
+def _run_sync(coro):
+    """ Run a coroutine that never suspends (like Variable.from_json of the built-in variables) to completion """
+
+    try:
+        coro.send(None)
+    except StopIteration as e:
+        return e.value
+    coro.close()
+    raise RuntimeError("Coroutine can not be completed synchronously.")
 
 
 class Config(SimpleNamespace):
@@ -57,20 +296,57 @@ class Config(SimpleNamespace):
     @classmethod
     async def new(cls, factory: CfgFactory, guild: Guild, row: ConfigTable) -> Any:
 
-        config = cls(factory, row)
+        config = cls(factory, row, guild)
+        if factory.lazy:
+            return config  # Variables will be wrapped in __getattr__()
+
         for var in config._factory.variables.values():
-            try:
-                obj = await var.from_json(row.cfg_data.get(var.name, var.default), guild)
-            except Exception as e:
-                Log.error("Failed to wrap variable '{}': {}".format(var.name, str(e)))
-                obj = await var.from_json(var.default, guild)
-            setattr(config, var.name, obj)
+            setattr(config, var.name, await config._wrap(var))
 
         return config
 
-    def __init__(self, factory, row):
+    def __init__(self, factory, row, guild=None):
         self._factory = factory
+        self._guild = guild
         self.row = row
+        # Jsonified values of the variables as they are stored in the db, shared with row.cfg_data
+        self._json = dict(row.cfg_data)
+        self.row.cfg_data = self._json
+        # Names of the variables changed since the last save
+        self._dirty = set()
+
+    def __getattr__(self, name: str) -> Any:
+        """ Wrap a variable of the lazy config on first access and memoize the result as an attribute """
+
+        if name.startswith('_') or (var := self._factory.variables.get(name)) is None:
+            raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}'")
+        try:
+            obj = _run_sync(self._wrap(var))
+        except RuntimeError:
+            raise RuntimeError(f"Variable '{name}' can't be wrapped lazily, its from_json() must not await.")
+        setattr(self, name, obj)
+        return obj
+
+    async def rewrap(self, guild: Guild):
+        """ Resolve the variables from the stored json again, against the given guild object """
+
+        self._guild = guild
+        for var in self._factory.variables.values():
+            if self._factory.lazy:
+                self.__dict__.pop(var.name, None)  # Will be wrapped on next access
+            else:
+                setattr(self, var.name, await self._wrap(var))
+
+    async def _wrap(self, var) -> Any:
+        """ Return useful object for a variable from the stored json, fallback to the default value on errors """
+
+        try:
+            return await var.from_json(self._json.get(var.name, var.default), self._guild)
+        except Exception as e:
+            Log.error("Failed to wrap variable '{}': {}".format(var.name, str(e)))
+            self._json[var.name] = var.default
+            self._dirty.add(var.name)
+            return await var.from_json(var.default, self._guild)
 
     async def update(self, guild: Guild, data: dict):
         # Validate data and save as useful objects in a dict
@@ -82,24 +358,74 @@ class Config(SimpleNamespace):
             objects[name] = await vo.from_string(value, guild)  # this may raise ValueError
             vo.verify(objects[name])
 
-        # Update self attributes
+        # Update self attributes, only changed variables are jsonified
         on_change_triggers = set()
         for key, value in objects.items():
             vo = self._factory.variables[key]
             setattr(self, key, objects[key])
+            self._json[key] = vo.jsonify(objects[key])
+            self._dirty.add(key)
             if vo.on_change:
                 on_change_triggers.add(vo.on_change)
 
         # Save to DB
-        self.row.cfg_data = self.jsonify()
-        await self.row.save()
+        if self._factory.write_behind:
+            self._factory.dirty[self.row.cfg_id] = self
+        else:
+            try:
+                await self.save()
+            except Exception:
+                # In-memory state no longer matches the DB, make next spawn() reload the config
+                self._factory.invalidate(self.row.cfg_id)
+                raise
+
+        # Make sure the updated object is the live one
+        self._factory.cache_put(self)
 
         # Trigger on_change events
         for f in on_change_triggers:
             f(self)  # TODO: maybe await f(self)
+        for f in CfgFactory.listeners:
+            f(self._factory, self, guild)
+
+    async def save(self, using_db=None):
+        """ Write changed variables to the db """
+
+        names, self._dirty = self._dirty, set()
+        try:
+            if not self.row._saved_in_db:
+                await self.row.save(using_db=using_db)
+            elif len(names):
+                if (query := self._partial_update_query(names, using_db)) is not None:
+                    conn, sql, values = query
+                    await conn.execute_query(sql, values)
+                else:
+                    await self.row.save(using_db=using_db, update_fields=['cfg_data'])
+        except Exception:
+            self._dirty |= names
+            raise
+
+    def _partial_update_query(self, names: set[str], using_db=None) -> tuple | None:
+        """
+        Build a query updating only given keys of the stored cfg_data json.
+        Returns (connection, sql, values) tuple or None if the db backend is not supported.
+        """
+
+        conn = using_db or self.row._meta.db
+        dialect = conn.capabilities.dialect
+        if dialect not in JSON_UPDATE_DIALECTS or (dialect == 'postgres' and 'asyncpg' not in type(conn).__module__):
+            return None
+        if (query := json_update_query(
+            dialect, self.row._meta.db_table, self.row.cfg_id, {name: self._json[name] for name in names}
+        )) is None:
+            return None
+        return conn, *query
 
     def jsonify(self) -> dict:
-        data = {name: var.jsonify(getattr(self, name)) for name, var in self._factory.variables.items()}
+        data = {
+            name: self._json[name] if name in self._json else var.jsonify(getattr(self, name))
+            for name, var in self._factory.variables.items()
+        }
         return data
 
     def readable(self) -> str:
@@ -109,4 +435,29 @@ class Config(SimpleNamespace):
         )
 
     async def delete(self):
+        self._factory.invalidate(self.row.cfg_id)
+        self._factory.dirty.pop(self.row.cfg_id, None)
         await self.row.delete()
+        for f in CfgFactory.listeners:
+            f(self._factory, self, self._guild)
+
+
+@dc.event
+async def on_ready():
+    # New Guild objects are created on a full reconnect, drop the configs made with the old ones
+    CfgFactory.invalidate_where(lambda guild: dc.get_guild(guild.id) is not guild)
+
+
+@dc.event
+async def on_guild_remove(guild):
+    CfgFactory.invalidate_guild(guild.id)
+
+
+@dc.event
+async def on_guild_role_delete(role):
+    CfgFactory.invalidate_guild(role.guild.id)
+
+
+@dc.event
+async def on_guild_channel_delete(channel):
+    CfgFactory.invalidate_guild(channel.guild.id)
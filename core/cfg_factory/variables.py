@@ -5,7 +5,8 @@ from datetime import timedelta
 from discord import Guild, Role, TextChannel
 import emoji
 
-from core.utils import get, find, parse_duration
+from core.utils import parse_duration
+from core.guild_index import GuildIndex
 
 
 class Variable:
@@ -81,7 +82,7 @@ class EmojiVar(Variable):
             return None
 
         if re.match("^:[^ ]*:$", string):
-            if (custom_emoji := get(guild.emojis, name=string.strip(':'))) is not None:
+            if (custom_emoji := GuildIndex.emoji(guild, string.strip(':'))) is not None:
                 return '<:{}:{}>'.format(custom_emoji.name, custom_emoji.id)
             return emoji.emojize(string, use_aliases=True)
         else:
@@ -163,7 +164,7 @@ class RoleVar(Variable):
             return role
 
         # Or this might be a role name
-        elif (role := find(lambda r: r.name.lower() == string.lower(), guild.roles)) is not None:
+        elif (role := GuildIndex.role(guild, string)) is not None:
             return role
 
         raise ValueError(f"Role '{string}' not found on the guild.")
@@ -196,7 +197,7 @@ class TextChanVar(Variable):
             return chan
 
         # Or this might be a channel name
-        elif type(chan := find(lambda c: c.name.lower() == string.lower().lstrip('#'), guild.channels)) is TextChannel:
+        elif type(chan := GuildIndex.channel(guild, string.lstrip('#'))) is TextChannel:
             return chan
 
         raise ValueError(f"Channel '{string}' not found on the guild.")
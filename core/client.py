@@ -1,7 +1,9 @@
+import asyncio
+import traceback
 import nextcord
 from discord import Guild
 from asyncio import iscoroutinefunction
-from core import Log
+from core import Log, cfg, Metrics
 
 
 class FakeMember:
@@ -43,43 +45,113 @@ class DiscordClient(nextcord.Client):
         super().__init__(*args, **kwargs)
 
         self.events = dict(on_init=[], on_think=[], on_exit=[])
+        self.event_options = dict()  # {coro: (sequential, timeout)}
         self.commands = dict()
+        self.prefixes = dict()  # {guild_id: prefix}, filled from the guild configs by the bot module
+        self.default_prefix = getattr(cfg, 'DC_DEFAULT_PREFIX', '!')
+        self.commands_metric = Metrics.counter('bot_commands_total', 'Commands run by the users.', ('command', ))
 
-    def event(self, coro):
+    def event(self, coro=None, *, sequential: bool = False, timeout: float = None):
         """This function replaces original decorator (that registers an event to listen to)
         allowing multiple functions to be registered on a single event.
+        Can be used as @dc.event or @dc.event(sequential=True, timeout=5).
+
+        When an event is dispatched, all handlers run concurrently and an exception or a timeout
+        in one handler does not affect the others. Handlers registered with sequential=True are
+        awaited one after another in the registration order (as a single chain running alongside
+        the concurrent ones).
         """
 
+        if coro is None:
+            return lambda f: self.event(f, sequential=sequential, timeout=timeout)
+
         if not iscoroutinefunction(coro):
             raise TypeError('event registered must be a coroutine function')
 
+        self.event_options[coro] = (sequential, timeout)
         if coro.__name__ not in self.events.keys():
             self.events[coro.__name__] = [coro]
+            handlers = self.events[coro.__name__]
 
             async def run_event(*args, **kwargs):
-                for task in self.events[coro.__name__]:
-                    await task(*args, **kwargs)
+                chain = [task for task in handlers if self.event_options[task][0]]
+                await asyncio.gather(
+                    *(self.run_handler(task, *args, **kwargs) for task in handlers if not self.event_options[task][0]),
+                    *([self.run_chain(chain, *args, **kwargs)] if len(chain) else [])
+                )
 
             setattr(self, coro.__name__, run_event)
 
         else:
             self.events[coro.__name__].append(coro)
+        return coro
+
+    async def run_handler(self, task, *args, **kwargs):
+        """ Run single event handler, log exceptions instead of raising them """
+
+        try:
+            if (timeout := self.event_options[task][1]) is not None:
+                await asyncio.wait_for(task(*args, **kwargs), timeout)
+            else:
+                await task(*args, **kwargs)
+        except asyncio.TimeoutError:
+            Log.error('Event handler {}.{} timed out after {} seconds.'.format(
+                task.__module__, task.__qualname__, self.event_options[task][1]
+            ))
+        except Exception as e:
+            Log.error('Error running event handler {}.{}: {}\n{}'.format(
+                task.__module__, task.__qualname__, str(e), traceback.format_exc()
+            ))
+
+    async def run_chain(self, tasks, *args, **kwargs):
+        for task in tasks:
+            await self.run_handler(task, *args, **kwargs)
 
     def command(self, *aliases):
+        """ Register a command, it will be called as coro(message, *args) on '{prefix}{alias} arg1 arg2...' message """
 
         def wrapper(coro):
             if not iscoroutinefunction(coro):
                 raise TypeError('command registered must be a coroutine function')
 
             for alias in aliases:
-                if alias in self.commands.keys():
+                if alias.lower() in self.commands.keys():
                     raise KeyError('a command with this alias already exists')
 
-                self.commands[alias] = coro
+                self.commands[alias.lower()] = coro
                 Log.debug('{} command alias registered from {}.'.format(alias, coro.__module__))
+            return coro
 
         return wrapper
 
+    async def run_command(self, message: nextcord.Message) -> bool:
+        """ Run a command if the message contains one, returns True if a command was found """
+
+        if message.author.bot:
+            return False
+
+        content = message.content
+        prefix = self.prefixes.get(message.guild.id, self.default_prefix) if message.guild else self.default_prefix
+        if not content.startswith(prefix):
+            return False
+
+        args = content[len(prefix):].split()
+        if not len(args) or (coro := self.commands.get(args[0].lower())) is None:
+            return False
+
+        if Log.enabled('COMMANDS'):
+            Log.command('{}|{}|{}: {}'.format(
+                message.guild.name if message.guild else 'DM', message.channel, message.author, content
+            ), guild=message.guild)
+        self.commands_metric.inc(args[0].lower())
+        try:
+            await coro(message, *args[1:])
+        except Exception as e:
+            Log.error('Error running command {} from {}: {}\n{}'.format(
+                args[0], coro.__module__, str(e), traceback.format_exc()
+            ), guild=message.guild)
+        return True
+
 
 intents = nextcord.Intents.default()
 intents.typing = False
@@ -1,9 +1,16 @@
 """ Logging and console interface with autocomplete by tab """
 
+import os
 import sys
+import time
+import json
+import gzip
+import shutil
+import atexit
+import asyncio
 import datetime
 from threading import Thread
-from multiprocessing import Queue
+from queue import SimpleQueue, Empty
 import rlcompleter  # this does python autocomplete by tab
 
 try:
@@ -16,7 +23,9 @@ from core.config import cfg
 
 class Console:
     alive = True
-    user_input_queue = Queue()
+    loop = None
+    on_input = None  # Coroutine function to run with every user input line
+    tasks = set()  # Running on_input tasks
     user_input_thread = None
 
     @classmethod
@@ -25,22 +34,33 @@ class Console:
         while True:
             try:
                 input_cmd = input('>')
-                cls.user_input_queue.put(input_cmd)
-            except EOFError:
+                cls.loop.call_soon_threadsafe(cls.run_input, input_cmd)
+            except (EOFError, RuntimeError):  # RuntimeError is raised if the event loop is closed
                 break
 
+    @classmethod
+    def run_input(cls, input_cmd):
+        """ Run on_input as a separate task, this is called from the event loop thread """
+
+        task = cls.loop.create_task(cls.on_input(input_cmd))
+        cls.tasks.add(task)
+        task.add_done_callback(cls.tasks.discard)
+
     @classmethod
     def terminate(cls):
         """ Set cls.alive flag to False, that should trigger the program termination from __main__ """
         cls.alive = False
 
     @classmethod
-    def init(cls):
+    def init(cls, on_input):
         """
-        Init console interface.
+        Init console interface, must be called from the running event loop.
         After running this function all application output should be handled via Log.
         """
 
+        cls.loop = asyncio.get_running_loop()
+        cls.on_input = on_input
+
         # Init user console
         cls.user_input_thread = Thread(target=cls.user_input_loop, name="user_input")
         cls.user_input_thread.daemon = True
@@ -55,62 +75,184 @@ class Log:
         'COMMANDS': 2,
         'INFO': 3,
         'ERRORS': 4,
+        'ERROR': 4,  # Level name of the error records
         'NOTHING': 5
     }
 
-    file = open(datetime.datetime.now().strftime("logs/log_%Y-%m-%d-%H:%M"), 'w')
     loglevel = LogLevelToInt[cfg.LOG_LEVEL]
 
+    # Log file output, 'text' or 'json' (one json object per line)
+    structured = getattr(cfg, 'LOG_FORMAT', 'text') == 'json'
+    file = None
+    file_opened_at = 0
+    # Rotate the log file when it reaches MAX_SIZE bytes or after ROTATE_INTERVAL seconds, 0 to disable
+    MAX_SIZE = getattr(cfg, 'LOG_MAX_SIZE', 0)
+    ROTATE_INTERVAL = getattr(cfg, 'LOG_ROTATE_INTERVAL', 0)
+
+    # Records are formatted and written by the writer thread in batches
+    queue = SimpleQueue()
+    writer_thread = None
+    BATCH_SIZE = 512  # Max records per write
+    FLUSH_INTERVAL = 1.0  # Max seconds between file flushes
+    FLUSH_SIZE = 64 * 1024  # Max unflushed characters
+
     @staticmethod
     def display(string):
         """ Print the string without messing the user input buffer """
 
-        # Have to do this encoding/decoding bullshit because python fails to encode some symbols by default
-        string = string.encode(sys.stdout.encoding, 'ignore').decode(sys.stdout.encoding)
-
         # Save user input line, print string and then user input line
         line_buffer = readline.get_line_buffer()
         sys.stdout.write("\r\n\033[F\033[K" + string + '\r\n>' + line_buffer)
+        sys.stdout.flush()
 
     @classmethod
-    def log(cls, data, log_level):
-        """ Perform formatting, run cls.display() and write to file """
-
-        # some characters may break the application, so re-encoding is needed
-        string = str(data).encode(sys.stdout.encoding, 'ignore').decode(sys.stdout.encoding)
+    def enabled(cls, log_level):
+        """ Check if records of the log level are written, useful to skip formatting of the expensive messages """
+        return cls.loglevel <= cls.LogLevelToInt[log_level] if log_level != 'DEBUG' else cls.loglevel == 1
 
-        string = "{}|{}> {}".format(
-            datetime.datetime.now().strftime("%d.%m.%Y (%H:%M:%S)"),
+    @classmethod
+    def log(cls, data, log_level, guild=None):
+        """ Pass the record to the writer thread """
+        cls.queue.put((
+            time.time(),
             log_level,
-            string)
-        cls.display(string)
-        cls.file.write(string + '\r\n')
+            str(data),
+            sys._getframe(2).f_globals.get('__name__') if cls.structured else None,
+            getattr(guild, 'id', guild)
+        ))
+
+    @classmethod
+    def open_file(cls):
+        """ Open a new log file named after the current time """
+
+        path = datetime.datetime.now().strftime("logs/log_%Y-%m-%d-%H:%M")
+        if (worker := os.environ.get('LUNODOG_WORKER')) is not None:  # Api worker process
+            path += f"_worker{worker}"
+        path += '.jsonl' if cls.structured else ''
+        base, n = path, 0
+        while os.path.exists(path) or os.path.exists(path + '.gz'):
+            n += 1
+            path = f"{base}.{n}"
+        cls.file = open(path, 'w')
+        cls.file_opened_at = time.time()
+
+    @classmethod
+    def rotate(cls):
+        """ Start a new log file and gzip the old one in background """
+
+        cls.file.close()
+        Thread(target=cls.compress, args=(cls.file.name,), name="log_compress").start()
+        cls.open_file()
+
+    @staticmethod
+    def compress(path):
+        try:
+            with open(path, 'rb') as f_in, gzip.open(path + '.gz', 'wb') as f_out:
+                shutil.copyfileobj(f_in, f_out)
+            os.remove(path)
+        except Exception as e:
+            sys.stderr.write(f"Failed to compress log file {path}: {e}\n")
+
+    @classmethod
+    def writer_loop(cls):
+        """ Format queued records, run cls.display() and write to file in batches """
+
+        unflushed = 0
+        last_flush = time.monotonic()
+        alive = True
+        while alive:
+            try:
+                records = [cls.queue.get(timeout=cls.FLUSH_INTERVAL)]
+            except Empty:
+                records = []
+            while len(records) < cls.BATCH_SIZE:
+                try:
+                    records.append(cls.queue.get_nowait())
+                except Empty:
+                    break
+            if None in records:  # cls.close() was called
+                records = records[:records.index(None)]
+                alive = False
+
+            try:
+                if len(records):
+                    # some characters may break the application, so re-encoding is needed
+                    string = "\r\n".join(
+                        "{}|{}> {}".format(
+                            datetime.datetime.fromtimestamp(timestamp).strftime("%d.%m.%Y (%H:%M:%S)"),
+                            log_level,
+                            data
+                        ) for timestamp, log_level, data, module, guild_id in records
+                    ).encode(sys.stdout.encoding, 'ignore').decode(sys.stdout.encoding)
+                    cls.display(string)
+
+                    if cls.structured:
+                        string = "\n".join(
+                            json.dumps(dict(
+                                ts=datetime.datetime.fromtimestamp(timestamp).isoformat(timespec='milliseconds'),
+                                level=log_level,
+                                module=module,
+                                guild_id=guild_id,
+                                msg=data
+                            ), ensure_ascii=False) for timestamp, log_level, data, module, guild_id in records
+                        ).encode(sys.stdout.encoding, 'ignore').decode(sys.stdout.encoding)
+                        cls.file.write(string + '\n')
+                    else:
+                        cls.file.write(string + '\r\n')
+                    unflushed += len(string)
+
+                if unflushed and (
+                    not alive or unflushed >= cls.FLUSH_SIZE or time.monotonic() - last_flush >= cls.FLUSH_INTERVAL
+                ):
+                    cls.file.flush()
+                    unflushed = 0
+                    last_flush = time.monotonic()
+
+                if alive and (
+                    (cls.MAX_SIZE and cls.file.tell() >= cls.MAX_SIZE) or
+                    (cls.ROTATE_INTERVAL and time.time() - cls.file_opened_at >= cls.ROTATE_INTERVAL)
+                ):
+                    cls.rotate()
+                    unflushed = 0
+            except Exception as e:
+                sys.stderr.write(f"Log writer failed: {e}\n")
 
     @classmethod
     def close(cls):
+        """ Write all queued records and close the log file """
+
+        if cls.writer_thread is not None and cls.writer_thread.is_alive():
+            cls.queue.put(None)
+            cls.writer_thread.join()
         cls.file.close()
 
     @classmethod
-    def chat(cls, data):
+    def chat(cls, data, guild=None):
         if cls.loglevel <= 0:
-            cls.log(data, 'CHAT')
+            cls.log(data, 'CHAT', guild)
 
     @classmethod
-    def debug(cls, data):
+    def debug(cls, data, guild=None):
         if cls.loglevel == 1:
-            cls.log(data, 'DEBUG')
+            cls.log(data, 'DEBUG', guild)
 
     @classmethod
-    def command(cls, data):
+    def command(cls, data, guild=None):
         if cls.loglevel <= 2:
-            cls.log(data, 'COMMANDS')
+            cls.log(data, 'COMMANDS', guild)
 
     @classmethod
-    def info(cls, data):
+    def info(cls, data, guild=None):
         if cls.loglevel <= 3:
-            cls.log(data, 'INFO')
+            cls.log(data, 'INFO', guild)
 
     @classmethod
-    def error(cls, data):
+    def error(cls, data, guild=None):
         if cls.loglevel <= 4:
-            cls.log(data, 'ERROR')
+            cls.log(data, 'ERROR', guild)
+
+
+Log.open_file()
+Log.writer_thread = Thread(target=Log.writer_loop, name="log_writer", daemon=True)
+Log.writer_thread.start()
+atexit.register(Log.close)
@@ -61,6 +61,16 @@ class Database:
         # After everything is done save models versions info
         await Versioning.write_versions(cls.__models__)
 
+    @classmethod
+    async def connect(cls):
+        """ Only init database connection, for the processes running along the main one (api workers) """
+        await Tortoise.init(cls.TORTOISE_CONFIG)
+
+    @staticmethod
+    def dialect() -> str:
+        """ Name of the connected database backend: 'sqlite', 'mysql', 'postgres'... """
+        return Tortoise.get_connection('default_conn').capabilities.dialect
+
     @staticmethod
     async def close():
         await Tortoise.close_connections()
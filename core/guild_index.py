@@ -0,0 +1,113 @@
+""" Name indexes of guild roles, channels and emojis """
+
+from discord import Guild, Role, Emoji
+from discord.abc import GuildChannel
+
+from .client import dc
+
+
+class GuildIndex:
+    """
+    Name -> object dicts for every guild, shared by all the cfg_factory Variables.
+    Indexes are built on first lookup and dropped or updated on the gateway events.
+    Roles and channels are looked up by lowercased name, emojis by exact name (emoji names are case-sensitive).
+    If several objects have the same name the first one (in the guild list order) wins.
+    On a full reconnect discord builds new Guild objects with new roles and channels, so the indexes
+    of a guild are rebuilt if they were made from another Guild object.
+    """
+
+    guilds = dict()  # {guild_id: Guild the indexes are built from}
+    roles = dict()  # {guild_id: {name: Role}}
+    channels = dict()  # {guild_id: {name: GuildChannel}}
+    emojis = dict()  # {guild_id: {name: Emoji}}
+
+    @classmethod
+    def _get_index(cls, index: dict, guild: Guild, items: list, key: callable) -> dict:
+        if cls.guilds.get(guild.id) is not guild:
+            cls.drop(guild.id)
+            cls.guilds[guild.id] = guild
+        if (names := index.get(guild.id)) is None:
+            names = index[guild.id] = dict()
+            for item in items:
+                names.setdefault(key(item), item)
+        return names
+
+    @classmethod
+    def role(cls, guild: Guild, name: str) -> Role | None:
+        return cls._get_index(cls.roles, guild, guild.roles, lambda r: r.name.lower()).get(name.lower())
+
+    @classmethod
+    def channel(cls, guild: Guild, name: str) -> GuildChannel | None:
+        return cls._get_index(cls.channels, guild, guild.channels, lambda c: c.name.lower()).get(name.lower())
+
+    @classmethod
+    def emoji(cls, guild: Guild, name: str) -> Emoji | None:
+        return cls._get_index(cls.emojis, guild, guild.emojis, lambda e: e.name).get(name)
+
+    @classmethod
+    def drop(cls, guild_id: int):
+        cls.guilds.pop(guild_id, None)
+        cls.roles.pop(guild_id, None)
+        cls.channels.pop(guild_id, None)
+        cls.emojis.pop(guild_id, None)
+
+    @classmethod
+    def clear(cls):
+        cls.guilds.clear()
+        cls.roles.clear()
+        cls.channels.clear()
+        cls.emojis.clear()
+
+
+@dc.event
+async def on_ready():
+    GuildIndex.clear()
+
+
+@dc.event
+async def on_guild_available(guild):
+    GuildIndex.drop(guild.id)
+
+
+@dc.event
+async def on_guild_role_create(role):
+    if (names := GuildIndex.roles.get(role.guild.id)) is not None:
+        names.setdefault(role.name.lower(), role)
+
+
+@dc.event
+async def on_guild_role_update(before, after):
+    if before.name != after.name:
+        GuildIndex.roles.pop(after.guild.id, None)
+
+
+@dc.event
+async def on_guild_role_delete(role):
+    GuildIndex.roles.pop(role.guild.id, None)
+
+
+@dc.event
+async def on_guild_channel_create(channel):
+    if (names := GuildIndex.channels.get(channel.guild.id)) is not None:
+        names.setdefault(channel.name.lower(), channel)
+
+
+@dc.event
+async def on_guild_channel_update(before, after):
+    if before.name != after.name:
+        GuildIndex.channels.pop(after.guild.id, None)
+
+
+@dc.event
+async def on_guild_channel_delete(channel):
+    GuildIndex.channels.pop(channel.guild.id, None)
+
+
+@dc.event
+async def on_guild_emojis_update(guild, before, after):
+    GuildIndex.emojis.pop(guild.id, None)
+
+
+@dc.event
+async def on_guild_remove(guild):
+    GuildIndex.drop(guild.id)
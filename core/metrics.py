@@ -0,0 +1,131 @@
+""" Counters, gauges and histograms registry with Prometheus text format export """
+
+from bisect import bisect_left
+
+
+def _labels(names: tuple, values: tuple) -> str:
+    if not len(names):
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for v in values)
+    return '{' + ','.join(f'{n}="{v}"' for n, v in zip(names, escaped)) + '}'
+
+
+class Counter:
+    type = 'counter'
+
+    def __init__(self, name: str, description: str, labels: tuple = ()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.values = dict()  # {label values: value}
+
+    def inc(self, *label_values, value: float = 1):
+        self.values[label_values] = self.values.get(label_values, 0) + value
+
+    def render(self, const: tuple) -> list[str]:
+        return [
+            f"{self.name}{_labels(const[0] + self.labels, const[1] + k)} {v}" for k, v in self.values.items()
+        ]
+
+
+class Gauge(Counter):
+    type = 'gauge'
+
+    def set(self, *label_values, value: float):
+        self.values[label_values] = value
+
+    def dec(self, *label_values, value: float = 1):
+        self.inc(*label_values, value=-value)
+
+
+class Histogram:
+    type = 'histogram'
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, name: str, description: str, labels: tuple = (), buckets: tuple = None):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets or self.BUCKETS)
+        self.values = dict()  # {label values: [bucket counts list, sum, count]}
+
+    def observe(self, value: float, *label_values):
+        if (data := self.values.get(label_values)) is None:
+            data = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0, 0]
+        data[0][bisect_left(self.buckets, value)] += 1
+        data[1] += value
+        data[2] += 1
+
+    def render(self, const: tuple) -> list[str]:
+        lines = []
+        names = const[0] + self.labels
+        for k, (counts, total, count) in self.values.items():
+            values = const[1] + k
+            cumulative = 0
+            for le, n in zip(self.buckets + ('+Inf', ), counts):
+                cumulative += n
+                lines.append(f"{self.name}_bucket{_labels(names + ('le', ), values + (le, ))} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(names, values)} {total}")
+            lines.append(f"{self.name}_count{_labels(names, values)} {count}")
+        return lines
+
+
+class Metrics:
+    """
+    Registry of the application metrics, usable from any module:
+        commands = Metrics.counter('bot_commands_total', 'Commands run', ['command'])
+        commands.inc('help')
+    """
+
+    metrics = dict()  # {name: metric}
+
+    @classmethod
+    def _get(cls, metric_class, name: str, *args, **kwargs):
+        if (metric := cls.metrics.get(name)) is None:
+            metric = cls.metrics[name] = metric_class(name, *args, **kwargs)
+        elif type(metric) is not metric_class:
+            raise TypeError(f"Metric {name} is already registered as {metric.type}")
+        return metric
+
+    @classmethod
+    def counter(cls, name: str, description: str, labels: tuple = ()) -> Counter:
+        return cls._get(Counter, name, description, labels)
+
+    @classmethod
+    def gauge(cls, name: str, description: str, labels: tuple = ()) -> Gauge:
+        return cls._get(Gauge, name, description, labels)
+
+    @classmethod
+    def histogram(cls, name: str, description: str, labels: tuple = (), buckets: tuple = None) -> Histogram:
+        return cls._get(Histogram, name, description, labels, buckets)
+
+    @classmethod
+    def collect(cls, const_labels: dict = None) -> dict:
+        """ Samples of all metrics {name: [type, description, sample lines]}, const_labels are added to every sample """
+
+        const = (tuple(const_labels.keys()), tuple(const_labels.values())) if const_labels else ((), ())
+        return {name: [m.type, m.description, m.render(const)] for name, m in cls.metrics.items()}
+
+    @staticmethod
+    def format(*collected: dict) -> str:
+        """ Merge collect() results, of several processes, into Prometheus text format """
+
+        merged = dict()
+        for samples in collected:
+            for name, (metric_type, description, lines) in samples.items():
+                if (metric := merged.get(name)) is None:
+                    merged[name] = [metric_type, description, list(lines)]
+                else:
+                    metric[2].extend(lines)
+
+        lines = []
+        for name, (metric_type, description, samples) in merged.items():
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            lines.extend(samples)
+        return "\n".join(lines) + "\n"
+
+    @classmethod
+    def render(cls, const_labels: dict = None) -> str:
+        """ Export all metrics in Prometheus text format, const_labels are added to every sample """
+        return cls.format(cls.collect(const_labels))
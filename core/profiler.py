@@ -0,0 +1,81 @@
+""" Timing of the background tasks with rolling percentiles per task """
+
+import time
+from collections import deque
+
+from .config import cfg
+from .console import Log
+
+
+class Profiler:
+    """
+    Keeps durations of the last WINDOW invocations of every background task and counts the ones over BUDGET seconds.
+    Use Profiler.report() from the console or /api/profiler to see the stats.
+    """
+
+    WINDOW = 512
+    BUDGET = getattr(cfg, 'TICK_BUDGET', 0.1)
+    LOG_INTERVAL = 60  # Min seconds between over budget log messages of a task, over_budget counts all of them
+
+    timings = dict()  # {task_name: deque of durations}
+    calls = dict()  # {task_name: total calls}
+    over_budget = dict()  # {task_name: total calls over the budget}
+    logged_at = dict()  # {task_name: time.monotonic() of the last over budget log message}
+
+    @staticmethod
+    def task_name(task: callable) -> str:
+        return f"{task.__module__}.{task.__qualname__}"
+
+    @classmethod
+    async def run(cls, task: callable, *args, **kwargs):
+        """ Await task(*args, **kwargs) and record its duration """
+
+        start = time.perf_counter()
+        try:
+            return await task(*args, **kwargs)
+        finally:
+            cls.record(cls.task_name(task), time.perf_counter() - start)
+
+    @classmethod
+    def record(cls, name: str, duration: float):
+        if (samples := cls.timings.get(name)) is None:
+            samples = cls.timings[name] = deque(maxlen=cls.WINDOW)
+        samples.append(duration)
+        cls.calls[name] = cls.calls.get(name, 0) + 1
+
+        if duration > cls.BUDGET:
+            cls.over_budget[name] = cls.over_budget.get(name, 0) + 1
+            if (now := time.monotonic()) - cls.logged_at.get(name, -cls.LOG_INTERVAL) >= cls.LOG_INTERVAL:
+                cls.logged_at[name] = now
+                Log.info(
+                    f"PROFILER| {name} took {duration * 1000:.1f}ms, budget is {cls.BUDGET * 1000:.0f}ms "
+                    f"({cls.over_budget[name]} times over budget in total)."
+                )
+
+    @classmethod
+    def stats(cls) -> dict:
+        """ Return {task_name: {calls, over_budget, p50, p95, p99, max}} with durations in milliseconds """
+
+        data = dict()
+        for name, samples in cls.timings.items():
+            ordered = sorted(samples)
+            data[name] = dict(
+                calls=cls.calls[name],
+                over_budget=cls.over_budget.get(name, 0),
+                **{f"p{q}": round(ordered[min(len(ordered) * q // 100, len(ordered) - 1)] * 1000, 3) for q in (50, 95, 99)},
+                max=round(ordered[-1] * 1000, 3)
+            )
+        return data
+
+    @classmethod
+    def report(cls) -> str:
+        """ Readable stats table, slowest tasks first """
+
+        lines = ["{:<48} {:>8} {:>6} {:>9} {:>9} {:>9} {:>9}".format(
+            'task', 'calls', 'over', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms'
+        )]
+        for name, s in sorted(cls.stats().items(), key=lambda i: i[1]['p95'], reverse=True):
+            lines.append("{:<48} {:>8} {:>6} {:>9} {:>9} {:>9} {:>9}".format(
+                name, s['calls'], s['over_budget'], s['p50'], s['p95'], s['p99'], s['max']
+            ))
+        return "\n".join(lines)
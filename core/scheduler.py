@@ -0,0 +1,106 @@
+""" Deadline based scheduler for the background tasks """
+
+import time
+import heapq
+import asyncio
+import traceback
+from itertools import count
+
+from .console import Log
+from .profiler import Profiler
+
+
+class Job:
+    """ Scheduled call of a coroutine function, returned by the Scheduler.call_* methods """
+
+    def __init__(self, deadline: float, coro: callable, args: tuple, interval: float = None):
+        self.deadline = deadline
+        self.coro = coro
+        self.args = args
+        self.interval = interval
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class Scheduler:
+    """
+    Runs one-shot and periodic coroutine calls at given deadlines. Jobs are scheduled on time.monotonic(),
+    so wall clock adjustments (NTP corrections) don't delay them or make them fire all at once.
+    The main loop awaits Scheduler.wait() which sleeps until the nearest deadline (or Scheduler.wake() call)
+    and then runs due jobs with Scheduler.run_pending().
+    """
+
+    jobs = []  # heap of (time.monotonic() deadline, seq, Job)
+    seq = count()  # Keeps the heap order stable for equal deadlines
+    wakeup = None  # asyncio.Event, set when an earlier deadline is scheduled
+
+    @classmethod
+    def call_at(cls, deadline: float, coro: callable, *args, interval: float = None) -> Job:
+        """ Run coro(*args) at the deadline (time.time() timestamp), then every interval seconds if set """
+        return cls._schedule(deadline - time.time() + time.monotonic(), coro, args, interval)
+
+    @classmethod
+    def call_later(cls, delay: float, coro: callable, *args) -> Job:
+        return cls._schedule(time.monotonic() + delay, coro, args)
+
+    @classmethod
+    def call_every(cls, interval: float, coro: callable, *args, delay: float = 0) -> Job:
+        return cls._schedule(time.monotonic() + delay, coro, args, interval)
+
+    @classmethod
+    def _schedule(cls, deadline: float, coro: callable, args: tuple, interval: float = None) -> Job:
+        if interval is not None and interval <= 0:
+            raise ValueError('Job interval must be positive.')
+        job = Job(deadline, coro, args, interval)
+        cls._push(job)
+        return job
+
+    @classmethod
+    def _push(cls, job: Job):
+        heapq.heappush(cls.jobs, (job.deadline, next(cls.seq), job))
+        if cls.jobs[0][2] is job:
+            cls.wake()
+
+    @classmethod
+    def wake(cls):
+        """ Interrupt Scheduler.wait() """
+        if cls.wakeup is not None:
+            cls.wakeup.set()
+
+    @classmethod
+    async def wait(cls):
+        """ Sleep until the nearest deadline """
+
+        if cls.wakeup is None:
+            cls.wakeup = asyncio.Event()
+
+        timeout = max(cls.jobs[0][0] - time.monotonic(), 0) if len(cls.jobs) else None
+        try:
+            await asyncio.wait_for(cls.wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        cls.wakeup.clear()
+
+    @classmethod
+    async def run_pending(cls):
+        """ Run all jobs with passed deadlines and reschedule periodic ones """
+
+        now = time.monotonic()
+        while len(cls.jobs) and cls.jobs[0][0] <= now:
+            deadline, _, job = heapq.heappop(cls.jobs)
+            if job.cancelled:
+                continue
+
+            try:
+                await Profiler.run(job.coro, *job.args)
+            except Exception as e:
+                Log.error('Error running background task from {}: {}\n{}'.format(
+                    job.coro.__module__, str(e), traceback.format_exc())
+                )
+
+            if job.interval is not None and not job.cancelled:
+                # Keep the period steady, but don't try to catch up on missed runs
+                job.deadline = max(deadline + job.interval, time.monotonic())
+                cls._push(job)
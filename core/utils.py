@@ -1,5 +1,7 @@
 import re
+import time
 import random
+from collections import OrderedDict
 from datetime import timedelta
 from nextcord.utils import get, find, escape_markdown
 
@@ -45,3 +47,47 @@ def parse_duration(string):
 def random_string(length):
     letters = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'
     return ''.join(random.choice(letters) for i in range(length))
+
+
+class TTLCache:
+    """ Size-bounded LRU cache with a time to live for every entry and hit/miss counters """
+
+    def __init__(self, max_size: int = 1024, ttl: float = 60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.data = OrderedDict()  # {key: (expires_at, value)}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        if (item := self.data.get(key)) is not None and item[0] > time.monotonic():
+            self.data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+        if item is not None:
+            del self.data[key]
+        self.misses += 1
+        return default
+
+    def set(self, key, value):
+        self.data[key] = (time.monotonic() + self.ttl, value)
+        self.data.move_to_end(key)
+        while len(self.data) > self.max_size:
+            self.data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        item = self.data.pop(key, None)
+        return item[1] if item is not None else default
+
+    def clear(self):
+        self.data.clear()
+
+    def info(self) -> dict:
+        total = self.hits + self.misses
+        return dict(
+            size=len(self.data),
+            max_size=self.max_size,
+            hits=self.hits,
+            misses=self.misses,
+            hit_ratio=round(self.hits / total, 4) if total else None
+        )
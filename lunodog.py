@@ -1,7 +1,6 @@
 import asyncio
 import signal
 import time
-import queue
 import traceback
 
 import core
@@ -11,22 +10,18 @@ import api
 
 def ctrl_c():
     core.Console.terminate()
+    core.Scheduler.wake()
 
 
 async def init():
     await core.Db.init()
-    core.Console.init()
+    core.Console.init(run_console)
     for task in core.dc.events['on_init']:
         await task()
 
 
-# Run commands from user console
-async def run_console():
-    try:
-        cmd = core.Console.user_input_queue.get(False)
-    except queue.Empty:
-        return
-
+# Run commands from user console, every command runs as a separate task
+async def run_console(cmd):
     core.Log.info(cmd)
     try:
         x = eval(cmd)
@@ -38,21 +33,27 @@ async def run_console():
         core.Log.error("CONSOLE| ERROR: " + str(e))
 
 
+# Compatibility layer for the on_think events, runs every 1 second from the scheduler
+async def think():
+    frame_time = time.time()
+    for task in core.dc.events['on_think']:
+        try:
+            await core.Profiler.run(task, frame_time)
+        except Exception as e:
+            core.Log.error('Error running background task from {}: {}\n{}'.format(
+                task.__module__, str(e), traceback.format_exc())
+            )
+    await core.cfg_factory.CfgFactory.think(frame_time)
+
+
 # Background logic loop
 async def main():
 
-    # Loop runs roughly every 1 second
+    # Loop sleeps until the nearest scheduled deadline
+    core.Scheduler.call_every(1, think)
     while core.Console.alive:
-        frame_time = time.time()
-        await run_console()
-        for task in core.dc.events['on_think']:
-            try:
-                await task(frame_time)
-            except Exception as e:
-                core.Log.error('Error running background task from {}: {}\n{}'.format(
-                    task.__module__, str(e), traceback.format_exc())
-                )
-        await asyncio.sleep(1)
+        await core.Scheduler.run_pending()
+        await core.Scheduler.wait()
 
     # Exit signal received
     for task in core.dc.events['on_exit']:
@@ -63,12 +64,15 @@ async def main():
                 task.__module__, str(e), traceback.format_exc())
             )
 
+    # Save write-behind configs updated by the bot or the exit tasks
+    await core.cfg_factory.CfgFactory.flush()
+
     core.Log.info("Waiting for connection to close...")
     await core.dc.close()
 
     if core.cfg.API_ENABLE:
         core.Log.info("Closing API server...")
-        await api.ApiServer.runner.cleanup()
+        await api.ApiServer.stop()
 
     core.Log.info("Closing db...")
     await core.Db.close()
@@ -1,4 +1,5 @@
 from core import dc, Log
+from core import cfg_factory as cf
 
 
 class Bot:
@@ -6,6 +7,21 @@ class Bot:
     was_ready = False
 
 
+def update_prefix(config):
+    dc.prefixes[config.row.cfg_id] = config.prefix
+
+
+guild_config = cf.CfgFactory(
+    name='guild_config',
+    display='Bot',
+    cache_size=None,  # One config per bot guild, warmed up on ready and dropped on guild remove
+    variables=[
+        cf.StrVar(name='prefix', display='Command prefix', default=dc.default_prefix, notnull=True,
+                  on_change=update_prefix)
+    ]
+)
+
+
 @dc.event
 async def on_think(frame_time: float):
 #    Log.debug(f'tick @ {frame_time}')
@@ -16,6 +32,8 @@ async def on_think(frame_time: float):
 async def on_ready():
     if not Bot.was_ready:
         Log.info(f"Logged in discord as '{dc.user.name}#{dc.user.discriminator}'.")
+        for config in (await guild_config.spawn_many([(g, g.id) for g in dc.guilds])).values():
+            update_prefix(config)
         Bot.was_ready = True
         Bot.bot_ready = True
     else:
@@ -33,3 +51,19 @@ async def on_resumed():
     Log.info("Connection to discord is resumed.")
     if Bot.was_ready:
         Bot.bot_ready = True
+
+
+@dc.event
+async def on_guild_join(guild):
+    update_prefix(await guild_config.spawn(guild, guild.id))
+
+
+@dc.event
+async def on_guild_remove(guild):
+    dc.prefixes.pop(guild.id, None)
+    guild_config.invalidate(guild.id)
+
+
+@dc.event
+async def on_message(message):
+    await dc.run_command(message)
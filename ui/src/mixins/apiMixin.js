@@ -25,6 +25,33 @@ export default {
       }
     },
 
+    // Open a websocket receiving change notifications for the user guilds, reconnects on connection loss.
+    // Returns a function closing the subscription.
+    apiSubscribe(onMessage) {
+      const url = this.$apiURL.replace(/^http/, 'ws') + '/push';
+      let ws = null;
+      let closed = false;
+      let retryDelay = 1000;
+
+      const connect = () => {
+        ws = new WebSocket(url);
+        ws.onopen = () => { retryDelay = 1000; };
+        ws.onmessage = (event) => onMessage(JSON.parse(event.data));
+        ws.onclose = () => {
+          if (!closed) {
+            setTimeout(connect, retryDelay);
+            retryDelay = Math.min(retryDelay * 2, 60000);
+          }
+        };
+      };
+      connect();
+
+      return () => {
+        closed = true;
+        ws.close();
+      };
+    },
+
     $_handleApiError(e) {
       let errorData = {title: 'Unknown Error', body: ''}
       const errorStore = useErrorStore();